@@ -77,7 +77,11 @@ setup(name='VideoConvertor',
       author_email='matys.jakub@gmail.com',
       url='https://github.com/jakm/VideoConvertor',
       package_dir={'': 'src'},
-      py_modules=['config', 'gui', 'process', 'scheduler', 'utils',
+      py_modules=['admission', 'affinity', 'backend', 'calibration',
+                  'config', 'control', 'fairshare', 'gui', 'history',
+                  'logwriter', 'memory', 'prefetch', 'priority', 'probe',
+                  'process', 'profiling', 'publish', 'results', 'scaling',
+                  'scheduler', 'throttle', 'timeline', 'utils', 'watchdog',
                   'win32reactor'],
       data_files=[('', ['config.ini']),
                   ('ui', ['ui/error_dialog.glade', 'ui/main.glade'])],
@@ -0,0 +1,344 @@
+# -*- coding: utf8 -*-
+"""
+Provides classes used by scheduler to decide whether task could be started.
+
+Each admission class implements this interface:
+- admit(task): return True if task could be started now,
+- task_started(task): called when process of task was started,
+- task_finished(task): called when process of task exited.
+"""
+
+import logging
+import os
+import os.path
+import sys
+
+from backend import get_backend
+from calibration import Calibrator
+from config import Configuration
+from scaling import VideoScaling
+
+
+class DiskSpaceAdmission(object):
+    """
+    Admission control that reserves predicted size of output file for each
+    running task on file system where the file is written. Task is admitted
+    only when free space of file system minus not yet written part of
+    reservations minus safety margin is greater than predicted size of its
+    output.
+
+    Size of output is predicted from calibration of input file when it was
+    calibrated, otherwise from probed duration of input and bitrates of
+    conversion command. When duration is unknown, size of input file is
+    used.
+    """
+    # container overhead
+    overhead = 0.02
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = Configuration()
+
+        self.enabled = self.config.getboolean('admission', 'disk_space_check')
+        margin = self.config.getint('admission', 'disk_space_margin')
+        self.margin = margin * 1024 * 1024
+
+        self.backend = get_backend()
+
+        self.reservations = {}
+
+    def admit(self, task):
+        """
+        @param task Task
+        @return bool, True if output of task fits to file system
+        """
+        if not self.enabled:
+            return True
+
+        import psutil
+
+        output_dir = os.path.dirname(os.path.abspath(task.work_file))
+        device = os.stat(output_dir).st_dev
+
+        free = psutil.disk_usage(output_dir).free
+        reserved = sum(self.get_unwritten_size(task_)
+                       for task_, device_ in self.reservations.iteritems()
+                       if device_ == device)
+        predicted = self.predict_output_size(task)
+
+        self.logger.debug('Task %s: predicted %d B, free %d B, reserved %d B',
+                          task, predicted, free, reserved)
+
+        return free - reserved - self.margin >= predicted
+
+    def task_started(self, task):
+        if not self.enabled:
+            return
+
+        output_dir = os.path.dirname(os.path.abspath(task.work_file))
+        self.reservations[task] = os.stat(output_dir).st_dev
+
+    def task_finished(self, task):
+        self.reservations.pop(task, None)
+
+    def get_unwritten_size(self, task):
+        """
+        Return part of reservation that is not written to disk yet.
+        @param task Task
+        @return int
+        """
+        try:
+            written = os.stat(task.work_file).st_size
+        except OSError:
+            written = 0
+
+        return max(0, self.predict_output_size(task) - written)
+
+    def predict_output_size(self, task):
+        """
+        Predict size of output file of task.
+        @param task Task
+        @return int, Size in bytes
+        """
+        calibration = Calibrator().get_cached(task.input_file)
+        if calibration is not None:
+            return int(calibration.output_size * (1 + self.overhead))
+
+        info = task.media_info
+
+        if info is None or info.duration is None:
+            return (info.file_size or 0) if info else 0
+
+        video_bitrate, audio_bitrate = self.get_bitrates(info)
+        size = info.duration * (video_bitrate + audio_bitrate) * 1000 / 8
+
+        return int(size * (1 + self.overhead))
+
+    def get_bitrates(self, info):
+        """
+        Return bitrates of video and audio from conversion parameters in
+        syntax of encoder backend, video bitrate could be given by tiers of
+        profile. Copied streams don't exceed them too.
+        @param info MediaInfo
+        @return tuple, (video bitrate, audio bitrate) in kbit/s
+        """
+        video_params = self.config.get('command', 'video_params')
+        bitrate_alias = self.config.get('command', 'video_bitrate_alias')
+        if bitrate_alias in video_params:
+            video_bitrate = VideoScaling().get_video_bitrate(info) or 0
+        else:
+            match = self.backend.video_bitrate_re.search(video_params)
+            video_bitrate = int(match.group(1)) if match else 0
+
+        audio_params = self.config.get('command', 'audio_params')
+        match = self.backend.audio_bitrate_re.search(audio_params)
+        audio_bitrate = int(match.group(1)) if match else 0
+
+        return (video_bitrate, audio_bitrate)
+
+
+class DeviceAdmission(object):
+    """
+    Admission control that limits count of running tasks per device. Each
+    task uses device of its input file and device where its output is
+    written. Limits are set for mount points in configuration, other devices
+    use default limit. Zero means unlimited.
+    """
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = Configuration()
+
+        self.default_limit = self.config.getint('devices', 'default_limit')
+        self.limits = self.parse_limits(self.config.get('devices', 'limits'))
+        self.logger.debug('Device limits: %s, default: %s', self.limits,
+                          self.default_limit)
+
+        self.devices_cache = {}
+        self.running = {}
+
+    def parse_limits(self, limits_str):
+        """
+        Parse limits in format 'mount point=limit; mount point=limit'.
+        @param limits_str str
+        @return dict, Map of mount point to limit
+        """
+        limits = {}
+
+        for item in limits_str.split(';'):
+            if not item.strip():
+                continue
+
+            mount_point, sep, limit = item.rpartition('=')
+            try:
+                limits[os.path.normcase(mount_point.strip())] = int(limit)
+            except ValueError:
+                self.logger.warning('Invalid device limit: %s', item)
+
+        return limits
+
+    def admit(self, task):
+        """
+        @param task Task
+        @return bool, True if no device of task is saturated
+        """
+        for device, mount_point in self.get_task_devices(task):
+            limit = self.limits.get(mount_point, self.default_limit)
+            if limit <= 0:
+                continue
+
+            running = sum(1 for devices in self.running.itervalues()
+                          if device in [device_ for device_, _ in devices])
+            if running >= limit:
+                self.logger.debug('Device %s is saturated (%d/%d)',
+                                  mount_point, running, limit)
+                return False
+
+        return True
+
+    def task_started(self, task):
+        self.running[task] = self.get_task_devices(task)
+
+    def task_finished(self, task):
+        self.running.pop(task, None)
+
+    def get_task_devices(self, task):
+        """
+        Return devices of task's input file and of directory where its
+        output is written.
+        @param task Task
+        @return set, Set of tuples (device id, mount point)
+        """
+        paths = (os.path.abspath(task.input_file),
+                 os.path.dirname(os.path.abspath(task.work_file)))
+
+        return set(self.get_device(path) for path in paths)
+
+    def get_device(self, path):
+        """
+        Return device id and mount point of path. Results are cached.
+        @param path str
+        @return tuple, (device id, mount point)
+        """
+        if path not in self.devices_cache:
+            device = os.stat(path).st_dev
+            self.devices_cache[path] = (device, self.get_mount_point(path))
+
+        return self.devices_cache[path]
+
+    def get_mount_point(self, path):
+        """
+        @param path str
+        @return str, Normalized mount point of path
+        """
+        if sys.platform == 'win32':
+            drive, _ = os.path.splitdrive(path)
+            return os.path.normcase(drive + '\\')
+
+        path = os.path.realpath(path)
+        while not os.path.ismount(path):
+            path = os.path.dirname(path)
+
+        return path
+
+
+class ThreadBudget(object):
+    """
+    Admission control that budgets CPU cores among encoder threads. Budget is
+    count of slots times threads per encoder of profile (or count of cores
+    given by configuration). Task is admitted when there is budget for base
+    count of threads.
+
+    When fewer tasks than free slots are waiting, i.e. at head of short
+    queue or at tail of batch, task gets more threads, so budget is used
+    whole. Count of threads is chosen when process is started and doesn't
+    change while it runs. Suspended (preempted) tasks don't use budget.
+    """
+    def __init__(self, slots):
+        """
+        Read settings from configuration.
+        @param slots list, Slots of scheduler, tasks or None for free slot
+        """
+        self.slots = slots
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = Configuration()
+
+        self.threads = max(1, self.config.getint('command', 'threads'))
+        self.max_threads = self.config.getint('command', 'max_threads')
+
+        self.budget = self.config.getint('scheduler', 'cores')
+        if self.budget <= 0:
+            self.budget = len(slots) * self.threads
+
+        self.logger.debug('Thread budget: %d, threads per task: %d, max: %s',
+                          self.budget, self.threads,
+                          self.max_threads or 'unlimited')
+
+    def get_used_threads(self):
+        """
+        @return int, Count of threads of tasks in slots
+        """
+        return sum(task.threads or self.threads for task in self.slots
+                   if task is not None)
+
+    def admit(self, task):
+        """
+        When all slots are occupied, task could be started only by preemption
+        of running task, which frees at least base count of threads, so it's
+        admitted.
+        @param task Task
+        @return bool, True if there is budget for base count of threads
+        """
+        if None not in self.slots:
+            return True
+
+        free = self.budget - self.get_used_threads()
+        if free < self.threads:
+            self.logger.debug('No budget for %s (%d of %d threads free)',
+                              task, free, self.budget)
+            return False
+
+        return True
+
+    def admit_resumed(self, task):
+        """
+        Check budget for preempted task, which is resumed with count of
+        threads assigned at its start. Task is always resumed when no other
+        task is running, so it can't wait forever.
+        @param task Task
+        @return bool, True if there is budget for threads of task
+        """
+        used = self.get_used_threads()
+        free = self.budget - used
+        if used > 0 and free < (task.threads or self.threads):
+            self.logger.debug('No budget for resuming %s (%d of %d threads '
+                              'free)', task, free, self.budget)
+            return False
+
+        return True
+
+    def task_started(self, task):
+        pass
+
+    def task_finished(self, task):
+        pass
+
+    def assign_threads(self, waiting_count):
+        """
+        Return count of threads for task that is being started. Free budget
+        is split among tasks which could be started now.
+        @param waiting_count int, Count of other tasks waiting in queue
+        @return int
+        """
+        free = self.budget - self.get_used_threads()
+        free_slots = self.slots.count(None)
+        starting = max(1, min(free_slots, waiting_count + 1))
+
+        threads = max(self.threads, free // starting)
+        if self.max_threads > 0:
+            threads = min(threads, max(self.threads, self.max_threads))
+
+        return threads
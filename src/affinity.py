@@ -0,0 +1,143 @@
+# -*- coding: utf8 -*-
+"""
+Provides class used to pin processes to CPU cores.
+"""
+
+import glob
+import logging
+import os.path
+import sys
+
+from config import Configuration
+
+
+def get_cpu_topology():
+    """
+    Return logical CPUs ordered by their placement, i.e. by socket and
+    physical core. Neighbouring CPUs share caches. When topology is unknown
+    (non-Linux platforms) CPUs are ordered by their numbers.
+    @return list, List of CPU numbers
+    """
+    import psutil
+
+    cpus = range(psutil.NUM_CPUS)
+
+    if not sys.platform.startswith('linux'):
+        return cpus
+
+    def read_id(cpu, name):
+        path = '/sys/devices/system/cpu/cpu%d/topology/%s' % (cpu, name)
+        try:
+            with open(path) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return 0
+
+    pattern = '/sys/devices/system/cpu/cpu[0-9]*'
+    cpus = [int(os.path.basename(path)[3:]) for path in glob.glob(pattern)]
+    cpus.sort(key=lambda cpu: (read_id(cpu, 'physical_package_id'),
+                               read_id(cpu, 'core_id'), cpu))
+    return cpus
+
+
+class CpuAffinity(object):
+    """
+    Class that assigns CPUs to scheduler's slots and pins processes running
+    in them. Assignment is given by configuration:
+
+    - empty: processes are not pinned,
+    - 'auto': CPUs are derived from topology. CPUs are split to contiguous
+      chunks among occupied slots in proportion to threads of their tasks, so
+      each process gets neighbouring cores. Assignment is rebalanced whenever
+      slot is occupied or freed, so when fewer processes run they get more
+      cores,
+    - list of CPU sets for each slot, e.g. '0,1;2,3' (fixed assignment).
+    """
+    def __init__(self, slots_count):
+        """
+        Read configuration and prepare assignment.
+        @param slots_count int, Count of scheduler's slots
+        """
+        self.slots_count = slots_count
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = Configuration()
+
+        self.mode = self.config.get('scheduler', 'cpu_affinity').strip()
+        self.cpus = []
+        self.slot_cpus = []
+
+        if self.mode == 'auto':
+            self.cpus = get_cpu_topology()
+        elif self.mode:
+            self.slot_cpus = [[int(cpu) for cpu in cpus.split(',')]
+                              for cpus in self.mode.split(';')]
+
+        self.logger.debug('CPU affinity: %s', self.mode or 'disabled')
+
+    @property
+    def enabled(self):
+        return bool(self.mode)
+
+    def get_assignment(self, occupied_slots, weights=None):
+        """
+        Return CPUs assigned to occupied slots.
+        @param occupied_slots list, Numbers of occupied slots
+        @param weights dict, Map of slot number to its share of CPUs (e.g.
+            count of threads), slots have equal shares by default
+        @return dict, Map of slot number to list of CPUs
+        """
+        assignment = {}
+
+        if self.slot_cpus:
+            for slot in occupied_slots:
+                assignment[slot] = self.slot_cpus[slot % len(self.slot_cpus)]
+            return assignment
+
+        slots = sorted(occupied_slots)
+        cpus_count = len(self.cpus)
+
+        if weights is None:
+            weights = {}
+        total_weight = sum(weights.get(slot, 1) for slot in slots)
+
+        weight = 0
+        for i, slot in enumerate(slots):
+            begin = weight * cpus_count // total_weight
+            weight += weights.get(slot, 1)
+            end = weight * cpus_count // total_weight
+            chunk = self.cpus[begin:end]
+            if not chunk:  # more slots than CPUs
+                chunk = [self.cpus[i % cpus_count]]
+            assignment[slot] = chunk
+
+        return assignment
+
+    def rebalance(self, slots):
+        """
+        Assign CPUs to occupied slots and pin their processes. Only processes
+        whose CPUs were changed are pinned again.
+        @param slots list, Tasks in slots or None for free slot
+        """
+        if not self.enabled:
+            return
+
+        occupied_slots = [slot for slot, task in enumerate(slots)
+                          if task is not None and task.process is not None]
+
+        weights = dict((slot, slots[slot].threads or 1)
+                       for slot in occupied_slots)
+        assignment = self.get_assignment(occupied_slots, weights)
+
+        for slot in occupied_slots:
+            task = slots[slot]
+            cpus = assignment[slot]
+
+            if task.cpus == cpus:
+                continue
+
+            self.logger.debug('Pinning %s in slot %d to CPUs %s', task, slot,
+                              cpus)
+            task.cpus = cpus
+            task.process.set_cpu_affinity(cpus)
@@ -0,0 +1,315 @@
+# -*- coding: utf8 -*-
+"""
+Provides encoder backends. Backend knows syntax and output of encoder
+program: how to probe input files, how to parse progress of conversion, how
+to put subtitles to command, how to select sample of input and whether
+streams could be copied. Conversion command itself is made from patterns of
+profile (section command of configuration file), which must be written in
+syntax of selected backend.
+
+Each backend class implements this interface:
+- get_probe_command(file_path): return arguments of probe command,
+- parse_probe_output(output, info): store values found in output of probe
+  command to MediaInfo and return their count,
+- parse_progress(output, duration): return dict with position, frames,
+  percent and fps from the last progress report in tail of output of
+  conversion process or None when there is no report,
+- add_subtitles(video_filters, sub_params): return video filters and
+  subtitle parameters put to command,
+- get_sample_args(start, length): return arguments selecting sample of
+  input,
+- stream_copy: True if streams could be copied without conversion,
+- video_bitrate_re, audio_bitrate_re: patterns of bitrates (kbit/s) in
+  video_params and audio_params.
+"""
+
+import json
+import logging
+import pipes
+import re
+import shlex
+import sys
+
+from config import Configuration
+from utils import encode, decode
+
+
+def get_backend(section='command'):
+    """
+    Return backend selected by profile. Unknown backend is logged and
+    mencoder is used.
+    @param section str, Section of conversion profile
+    @return EncoderBackend
+    """
+    name = Configuration().get(section, 'backend')
+
+    if name not in backends:
+        logging.getLogger('EncoderBackend').warning(
+            'Unknown backend %s, using mencoder', name)
+        name = 'mencoder'
+
+    return backends[name]()
+
+
+class EncoderBackend(object):
+    """
+    Base of encoder backends. Probe program is defined in section of
+    configuration file given by probe_section.
+    """
+    name = None
+    probe_section = None
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = Configuration()
+
+    def get_probe_command(self, file_path):
+        """
+        Make probe command from patterns in application's config file.
+        @param file_path str
+        @return list, Command arguments
+        """
+        if sys.platform in ('win32', 'cygwin'):
+            probe_exe = self.config.get(self.probe_section, 'probe_exe_win')
+        else:
+            probe_exe = self.config.get(self.probe_section, 'probe_exe_unix')
+
+        input_file_alias = self.config.get('command', 'input_file_alias')
+        probe_args = self.config.get(self.probe_section, 'probe_args')
+        probe_args = probe_args.replace(input_file_alias, file_path)
+
+        probe_command = '"' + probe_exe + '" ' + probe_args
+
+        return shlex.split(encode(probe_command))
+
+
+class MencoderBackend(EncoderBackend):
+    """
+    Backend of mencoder. Files are probed by mplayer -identify.
+    """
+    name = 'mencoder'
+    probe_section = 'probe'
+    stream_copy = True
+    video_bitrate_re = re.compile(r'vbitrate=(\d+)')
+    audio_bitrate_re = re.compile(r'\bbr=(\d+)')
+
+    # map of identify keys to (attribute, type)
+    identify_map = {'ID_DEMUXER': ('demuxer', str),
+                    'ID_LENGTH': ('duration', float),
+                    'ID_VIDEO_WIDTH': ('width', int),
+                    'ID_VIDEO_HEIGHT': ('height', int),
+                    'ID_VIDEO_ASPECT': ('aspect', float),
+                    'ID_VIDEO_FPS': ('fps', float),
+                    'ID_VIDEO_FORMAT': ('video_format', str),
+                    'ID_VIDEO_BITRATE': ('video_bitrate', int),
+                    'ID_AUDIO_FORMAT': ('audio_format', str),
+                    'ID_AUDIO_BITRATE': ('audio_bitrate', int)}
+
+    # status line of mencoder, e.g.
+    # Pos:  12.3s    296f ( 2%) 45.12fps Trem:   5min  68mb  A-V:0.000 [1800:128]
+    progress_re = re.compile(r'Pos:\s*(?P<position>[\d.]+)s\s+(?P<frames>\d+)f\s+'
+                             r'\(\s*(?P<percent>\d+)%\)\s+(?P<fps>[\d.]+)fps')
+
+    def parse_probe_output(self, output, info):
+        """
+        Parse lines in format KEY=VALUE and store known keys to info.
+        @param output str, Output of probe command
+        @param info MediaInfo
+        @return int, Count of stored values
+        """
+        count = 0
+
+        for line in output.splitlines():
+            key, sep, value = line.strip().partition('=')
+            if not sep or key not in self.identify_map:
+                continue
+
+            attribute, type_ = self.identify_map[key]
+            try:
+                value = type_(value)
+            except ValueError:
+                continue
+
+            if type_ is not str and value <= 0:
+                continue  # zero means unknown
+
+            setattr(info, attribute, value)
+            count += 1
+
+        return count
+
+    def parse_progress(self, output, duration=None):
+        match = None
+        for match in self.progress_re.finditer(output):
+            pass
+
+        if match is None:
+            return None
+
+        return {'position': float(match.group('position')),
+                'frames': int(match.group('frames')),
+                'percent': int(match.group('percent')),
+                'fps': float(match.group('fps'))}
+
+    def add_subtitles(self, video_filters, sub_params):
+        """
+        Subtitles are rendered by options of mencoder, so parameters are not
+        changed.
+        @param video_filters str
+        @param sub_params str
+        @return tuple, (video filters, subtitle parameters)
+        """
+        return (video_filters, sub_params)
+
+    def get_sample_args(self, start, length):
+        return '-ss %.2f -endpos %.2f' % (start, length)
+
+
+class FfmpegBackend(EncoderBackend):
+    """
+    Backend of ffmpeg. Files are probed by ffprobe with JSON output. Profile
+    must let ffmpeg write progress to stdout (-progress pipe:1).
+    """
+    name = 'ffmpeg'
+    probe_section = 'ffprobe'
+    stream_copy = True
+    video_bitrate_re = re.compile(r'-b:v\s+(\d+)k')
+    audio_bitrate_re = re.compile(r'-b:a\s+(\d+)k')
+
+    # report of -progress option, key=value lines, e.g.
+    # frame=296
+    # fps=45.12
+    # out_time=00:00:12.300000
+    frame_re = re.compile(r'^frame=(\d+)', re.M)
+    fps_re = re.compile(r'^fps=([\d.]+)', re.M)
+    out_time_re = re.compile(r'^out_time=(\d+):(\d+):([\d.]+)', re.M)
+
+    video_filter_options = ('-vf', '-filter:v')
+
+    def parse_probe_output(self, output, info):
+        """
+        Parse JSON with format and streams and store found values to info.
+        The first video and audio streams are used.
+        @param output str, Output of probe command
+        @param info MediaInfo
+        @return int, Count of stored values
+        """
+        try:
+            data = json.loads(output)
+        except ValueError:
+            return 0
+
+        values = {}
+
+        format_ = data.get('format', {})
+        values['demuxer'] = (format_.get('format_name'), str)
+        values['duration'] = (format_.get('duration'), float)
+
+        streams = data.get('streams', [])
+        video = [s for s in streams if s.get('codec_type') == 'video']
+        audio = [s for s in streams if s.get('codec_type') == 'audio']
+
+        if video:
+            video = video[0]
+            values['width'] = (video.get('width'), int)
+            values['height'] = (video.get('height'), int)
+            values['video_format'] = (video.get('codec_name'), str)
+            values['video_bitrate'] = (video.get('bit_rate'), int)
+            values['fps'] = (self.parse_ratio(video.get('avg_frame_rate'),
+                                              '/'), float)
+            values['aspect'] = (self.parse_ratio(
+                video.get('display_aspect_ratio'), ':'), float)
+
+        if audio:
+            audio = audio[0]
+            values['audio_format'] = (audio.get('codec_name'), str)
+            values['audio_bitrate'] = (audio.get('bit_rate'), int)
+
+        count = 0
+
+        for attribute, (value, type_) in values.iteritems():
+            if value is None:
+                continue
+
+            try:
+                value = type_(value)
+            except ValueError:
+                continue
+
+            if type_ is not str and value <= 0:
+                continue  # zero means unknown
+
+            setattr(info, attribute, value)
+            count += 1
+
+        return count
+
+    def parse_ratio(self, value, separator):
+        """
+        @param value str or None, Ratio, e.g. 30000/1001 or 16:9
+        @param separator str
+        @return float or None, None when value is unknown
+        """
+        numerator, sep, denominator = (value or '').partition(separator)
+        try:
+            return float(numerator) / float(denominator)
+        except (ValueError, ZeroDivisionError):
+            return None
+
+    def parse_progress(self, output, duration=None):
+        frames = self.frame_re.findall(output)
+        if not frames:
+            return None
+
+        fps = self.fps_re.findall(output)
+        out_time = self.out_time_re.findall(output)
+
+        position = None
+        if out_time:
+            hours, minutes, seconds = out_time[-1]
+            position = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+        percent = None
+        if position is not None and duration:
+            percent = min(100, int(position * 100 / duration))
+
+        return {'position': position,
+                'frames': int(frames[-1]),
+                'percent': percent,
+                'fps': float(fps[-1]) if fps else None}
+
+    def add_subtitles(self, video_filters, sub_params):
+        """
+        Subtitles are burnt in by subtitles filter, subtitle parameters of
+        profile are video filter options (e.g. -vf subtitles=...). Only the
+        last -vf option is used by ffmpeg, so all filters are joined to one
+        chain.
+        @param video_filters str
+        @param sub_params str
+        @return tuple, (video filters, subtitle parameters)
+        """
+        options = shlex.split(encode(video_filters + ' ' + sub_params))
+
+        filters = []
+        other_options = []
+        while options:
+            option = options.pop(0)
+            if option in self.video_filter_options and options:
+                filters.append(options.pop(0))
+            else:
+                other_options.append(option)
+
+        if filters:
+            other_options += ['-vf', ','.join(filters)]
+
+        video_filters = ' '.join(pipes.quote(option)
+                                 for option in other_options)
+        return (decode(video_filters), '')
+
+    def get_sample_args(self, start, length):
+        return '-ss %.2f -t %.2f' % (start, length)
+
+
+backends = {MencoderBackend.name: MencoderBackend,
+            FfmpegBackend.name: FfmpegBackend}
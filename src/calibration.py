@@ -0,0 +1,256 @@
+# -*- coding: utf8 -*-
+"""
+Provides classes used to estimate cost of conversion by encoding a sample.
+"""
+
+import logging
+import os
+import os.path
+import tempfile
+
+from twisted.internet import defer
+
+from config import Configuration
+from history import EncodeHistory
+from process import ConversionProcess
+from utils import singleton, async_function
+
+
+class CalibrationResult(object):
+    """
+    Simple structure that keeps result of sample conversion and estimates
+    extrapolated to whole file.
+    """
+    sample_length = None
+    sample_run_time = None
+    sample_size = None
+    fps = None
+    run_time = None
+    output_size = None
+
+    def __str__(self):
+        return ('<CalibrationResult run_time=%.1f output_size=%d fps=%s>'
+                % (self.run_time, self.output_size, self.fps))
+
+
+class CalibrationProcess(ConversionProcess):
+    """
+    Conversion process that converts only sample of input file. Arguments
+    selecting sample are given by encoder backend and put in front of
+    arguments of conversion command, process runs with priority given by
+    section calibration of configuration file.
+    """
+    priority_section = 'calibration'
+
+    def __init__(self, input_file, sub_file, output_file, media_info, start,
+                 length):
+        """
+        @param input_file str, Path to input file
+        @param sub_file str, Path to subtitles file
+        @param output_file str, Path to output file of sample
+        @param media_info MediaInfo, Probed information about input file
+        @param start float, Position of sample in seconds
+        @param length float, Length of sample in seconds
+        """
+        ConversionProcess.__init__(self, input_file, sub_file, output_file,
+                                   media_info=media_info)
+
+        self.extra_args = self.backend.get_sample_args(start, length)
+
+
+@singleton
+class Calibrator(object):
+    """
+    Singleton class that estimates run time and output size of conversion of
+    file by converting short sample from middle of file with the same
+    conversion command. Only files of type that is not known from history
+    of conversions (see EncodeHistory) and which are long enough are
+    calibrated. Results are cached by file path and conversion profile. Count
+    of concurrently running calibrations is limited by configuration.
+
+    Running calibration processes are registered in set of processes given
+    by caller, so they are paused, throttled and terminated together with
+    conversions. Cancelled calibrations are not cached.
+    """
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = Configuration()
+
+        self.enabled = self.config.getboolean('calibration', 'enabled')
+        self.sample_length = self.config.getfloat('calibration',
+                                                  'sample_length')
+        self.min_duration = self.config.getfloat('calibration',
+                                                 'min_duration')
+        self.max_distance = self.config.getfloat('calibration',
+                                                 'max_distance')
+
+        self.history = EncodeHistory()
+
+        self.cache = {}
+        self.pending = {}
+        # incremented by cancel, calibrations of older generation don't start
+        self.generation = 0
+
+        processes_count = self.config.getint('calibration', 'processes_count')
+        self.semaphore = defer.DeferredSemaphore(processes_count)
+
+    def get_key(self, file_path):
+        return (file_path, self.history.profile)
+
+    def get_cached(self, file_path):
+        """
+        Return result of calibration of file or None when file wasn't
+        calibrated or calibration failed.
+        @param file_path str
+        @return CalibrationResult or None
+        """
+        return self.cache.get(self.get_key(file_path))
+
+    def needs_calibration(self, info):
+        """
+        @param info MediaInfo, Probed information about file
+        @return bool, True if file should be calibrated before its conversion
+        """
+        if not self.enabled or info is None or not info.duration:
+            return False
+
+        if info.duration < self.min_duration:
+            return False
+
+        if self.get_key(info.file_path) in self.cache:
+            return False
+
+        distance = self.history.get_nearest_distance(info)
+        return distance is None or distance > self.max_distance
+
+    def is_pending(self, file_path):
+        """
+        @param file_path str
+        @return bool, True if file is being calibrated
+        """
+        return self.get_key(file_path) in self.pending
+
+    def calibrate(self, input_file, sub_file, output_file, info,
+                  processes=None):
+        """
+        Convert sample of file and estimate cost of its conversion. Failure
+        of calibration is not propagated, result is None then.
+        @param input_file str
+        @param sub_file str
+        @param output_file str, Path to output file, used for its extension
+        @param info MediaInfo, Probed information about file
+        @param processes set, Set where running process is registered
+        @return t.i.d.Deferred, CalibrationResult or None
+        """
+        key = self.get_key(input_file)
+        if key in self.cache:
+            return defer.succeed(self.cache[key])
+
+        d = defer.Deferred()
+
+        if key in self.pending:
+            self.pending[key].append(d)
+            return d
+
+        self.pending[key] = [d]
+
+        def calibration_finished(result):
+            self.cache[key] = result
+            for waiting in self.pending.pop(key):
+                waiting.callback(result)
+
+        def calibration_cancelled(fail):
+            fail.trap(defer.CancelledError)
+            self.logger.info('Calibration of %s cancelled', input_file)
+            for waiting in self.pending.pop(key):
+                waiting.callback(None)
+
+        calibrate_d = self.semaphore.run(self._calibrate, input_file,
+                                         sub_file, output_file, info,
+                                         processes, self.generation)
+        calibrate_d.addCallbacks(calibration_finished, calibration_cancelled)
+
+        return d
+
+    def cancel(self):
+        """
+        Cancel calibrations waiting for start. Running processes are
+        terminated by owner of their set of processes.
+        """
+        self.generation += 1
+
+    @defer.inlineCallbacks
+    def _calibrate(self, input_file, sub_file, output_file, info, processes,
+                   generation):
+        """
+        Run conversion of sample and extrapolate its results.
+        @return t.i.d.Deferred, CalibrationResult or None
+        @raise t.i.d.CancelledError when calibration was cancelled
+        """
+        if generation != self.generation:
+            raise defer.CancelledError()
+
+        if processes is None:
+            processes = set()
+
+        length = min(self.sample_length, info.duration)
+        start = max(0.0, (info.duration - length) / 2)
+
+        extension = os.path.splitext(output_file)[1]
+        fd, sample_file = tempfile.mkstemp(prefix='videoconvertor_',
+                                           suffix=extension)
+        os.close(fd)
+
+        self.logger.debug('Calibrating %s on %.1f s from %.1f s', input_file,
+                          length, start)
+
+        process = CalibrationProcess(input_file, sub_file, sample_file, info,
+                                     start, length)
+
+        result = None
+        try:
+            d = process.run()
+            processes.add(process)
+            try:
+                yield d
+            finally:
+                processes.discard(process)
+
+            if process.returncode != 0:
+                raise ValueError('process failed with code %s'
+                                 % process.returncode)
+
+            sample_size = yield self.get_file_size(sample_file)
+            sample_run_time = process.get_run_time()
+            if sample_run_time <= 0 or not sample_size:
+                raise ValueError('no output')
+
+            result = CalibrationResult()
+            result.sample_length = length
+            result.sample_run_time = sample_run_time
+            result.sample_size = sample_size
+            result.fps = process.fps
+            result.run_time = info.duration * sample_run_time / length
+            result.output_size = int(info.duration * sample_size / length)
+
+            self.logger.info('Calibrated %s: %s', input_file, result)
+        except defer.CancelledError:
+            raise
+        except Exception as e:
+            self.logger.warning('Calibration of %s failed: %s', input_file, e)
+        finally:
+            yield self.remove_file(sample_file)
+
+        defer.returnValue(result)
+
+    @async_function
+    def get_file_size(self, file_path):
+        return os.path.getsize(file_path)
+
+    @async_function
+    def remove_file(self, file_path):
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
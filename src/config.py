@@ -26,7 +26,7 @@ class Configuration(object):
         return self.parser.getboolean(section, option)
 
     def getfloat(self, section, option):
-        return self.parser.getfload(section, option)
+        return self.parser.getfloat(section, option)
 
     def getint(self, section, option):
         return self.parser.getint(section, option)
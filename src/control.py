@@ -0,0 +1,407 @@
+# -*- coding: utf8 -*-
+"""
+Provides local HTTP API used to control application programmatically.
+
+Resources (all bodies are JSON):
+- GET /tasks: list tasks in queue,
+- POST /tasks: submit jobs, body {"jobs": [{"file": path, "subtitles": path,
+  "queue": name, "priority": 0-3}, ...], "start": bool},
+- GET /tasks/<id>: state of task (queued or recently finished),
+- POST /tasks/<id>: change priority of task, body {"priority": 0-3},
+- DELETE /tasks/<id>: cancel task,
+- GET /scheduler: state of scheduler and statistics of queues,
+- POST /scheduler: body {"action": "start" | "pause" | "resume" | "cancel"},
+- GET /events: stream of events, one JSON object per line.
+"""
+
+import json
+import logging
+import os.path
+from collections import OrderedDict
+
+from twisted.web import resource, server
+
+from config import Configuration
+
+
+def json_response(request, data, code=200):
+    """
+    Set response code and headers and serialize data.
+    @param request t.w.s.Request
+    @param data object, JSON serializable data
+    @param code int, HTTP response code
+    @return str
+    """
+    request.setResponseCode(code)
+    request.setHeader('Content-Type', 'application/json')
+    return json.dumps(data) + '\n'
+
+
+def error_response(request, code, message):
+    """
+    @param request t.w.s.Request
+    @param code int, HTTP response code
+    @param message str, Description of error
+    @return str
+    """
+    return json_response(request, {'error': message}, code)
+
+
+def read_json(request):
+    """
+    Parse JSON body of request.
+    @param request t.w.s.Request
+    @return dict
+    @raise ValueError when body is not valid JSON object
+    """
+    body = request.content.read()
+    data = json.loads(body) if body.strip() else {}
+    if not isinstance(data, dict):
+        raise ValueError('body should be JSON object')
+    return data
+
+
+def check_priority(priority):
+    """
+    Check that priority is one of priorities shown by GUI.
+    @param priority object
+    @raise ValueError when priority is invalid
+    """
+    # bool is subclass of int
+    if type(priority) is not int or not 0 <= priority <= 3:
+        raise ValueError('priority should be integer from 0 to 3')
+
+
+def to_str(value):
+    """
+    Convert unicode from JSON to UTF-8 string used in GUI.
+    @param value unicode or None
+    @return str or None
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class ControlServer(object):
+    """
+    Class that serves control API on local TCP port or UNIX socket. API is
+    backed by scheduler of GUI, operations with scheduler are done through
+    GUI, so its widgets stay consistent. States of recently finished tasks
+    are remembered, so they could be queried.
+    """
+    def __init__(self, gui):
+        """
+        Read settings and set object's attributes.
+        @param gui VideoConvertorGUI
+        """
+        self.gui = gui
+        self.scheduler = gui.scheduler
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = Configuration()
+
+        self.enabled = self.config.getboolean('control', 'enabled')
+        self.interface = self.config.get('control', 'interface')
+        self.port = self.config.getint('control', 'port')
+        self.socket = self.config.get('control', 'socket')
+        self.history_size = self.config.getint('control', 'history_size')
+
+        self.history = OrderedDict()
+        self.listening_port = None
+
+    def start(self):
+        """
+        Start listening when API is enabled.
+        """
+        from twisted.internet import reactor
+
+        if not self.enabled:
+            return
+
+        self.scheduler.add_listener(self.remember_finished_task)
+
+        root = resource.Resource()
+        root.putChild('tasks', TasksResource(self))
+        root.putChild('scheduler', SchedulerResource(self))
+        root.putChild('events', EventsResource(self))
+
+        site = server.Site(root)
+        site.displayTracebacks = False
+
+        if self.socket:
+            self.logger.info('Control API listening on %s', self.socket)
+            self.listening_port = reactor.listenUNIX(self.socket, site,
+                                                     wantPID=True)
+        else:
+            self.logger.info('Control API listening on %s:%s',
+                             self.interface, self.port)
+            self.listening_port = reactor.listenTCP(self.port, site,
+                                                    interface=self.interface)
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        """
+        Stop listening.
+        @return t.i.d.Deferred or None
+        """
+        if self.listening_port is None:
+            return None
+
+        self.scheduler.remove_listener(self.remember_finished_task)
+
+        port, self.listening_port = self.listening_port, None
+        return port.stopListening()
+
+    def remember_finished_task(self, event):
+        """
+        Listener of scheduler that remembers last states of finished and
+        cancelled tasks.
+        @param event dict
+        """
+        if event['event'] not in ('task_finished', 'task_cancelled'):
+            return
+
+        self.history[event['row_id']] = event
+        while len(self.history) > self.history_size:
+            self.history.popitem(last=False)
+
+    def get_task_info(self, row):
+        """
+        @param row QueueRow
+        @return dict, Description of task in queue
+        """
+        return {'id': row['id'],
+                'file': row['file_path'],
+                'subtitles': row['sub_path'],
+                'queue': row['queue'],
+                'priority': row['priority'],
+                'queued_at': row['queued_at'],
+                'predicted_run_time': self.scheduler.predict_run_time(row),
+                'state': self.scheduler.get_task_state(row['id'])}
+
+    def get_tasks(self):
+        """
+        @return list, Descriptions of tasks in queue
+        """
+        return [self.get_task_info(row) for row in self.scheduler.tasks_queue]
+
+    def get_task(self, row_id):
+        """
+        @param row_id int
+        @return dict or None, Description of task in queue or of finished
+            task, None when task is unknown
+        """
+        row = self.scheduler.get_row_by_id(row_id)
+        if row is not None:
+            return self.get_task_info(row)
+
+        event = self.history.get(row_id)
+        if event is None:
+            return None
+
+        info = dict(event)
+        info['id'] = info.pop('row_id')
+        info['file'] = info.pop('input_file')
+        info['state'] = ('cancelled' if event['event'] == 'task_cancelled'
+                         else event['status'])
+        return info
+
+    def submit(self, jobs):
+        """
+        Append jobs to queue. Jobs are validated first, nothing is appended
+        when any job is invalid.
+        @param jobs list, List of dicts with keys file, subtitles, queue and
+            priority
+        @return list, IDs of new tasks
+        @raise ValueError when some job is invalid
+        """
+        if not isinstance(jobs, list):
+            raise ValueError('jobs should be list')
+
+        for job in jobs:
+            if (not isinstance(job, dict)
+                    or not isinstance(job.get('file'), basestring)):
+                raise ValueError('job should be object with string file')
+            for key in ('subtitles', 'queue'):
+                value = job.get(key)
+                if value is not None and not isinstance(value, basestring):
+                    raise ValueError('%s should be string' % key)
+            for key in ('file', 'subtitles'):
+                path = to_str(job.get(key))
+                if path is not None and not os.path.isfile(path):
+                    raise ValueError('file not found: %s' % path)
+            if job.get('priority') is not None:
+                check_priority(job['priority'])
+
+        self.logger.info('Submitting %d jobs', len(jobs))
+
+        ids = []
+        for job in jobs:
+            row_id = self.gui.add_file_name(
+                to_str(job['file']), queue_name=to_str(job.get('queue')),
+                priority=job.get('priority'),
+                sub_file_name=to_str(job.get('subtitles')))
+            ids.append(row_id)
+
+        return ids
+
+    def get_scheduler_state(self):
+        """
+        @return dict, State of scheduler and statistics of queues
+        """
+        scheduler = self.scheduler
+        return {'running': scheduler.running,
+                'paused': scheduler.paused,
+                'queued': len(scheduler.tasks_queue),
+                'done': scheduler.results.counts['done'],
+                'incomplete': scheduler.results.counts['incomplete'],
+                'failed': scheduler.results.counts['failed'],
+                'queues': scheduler.fairshare.get_stats()}
+
+    def control_scheduler(self, action):
+        """
+        Start, pause, resume or cancel conversion. Buttons of GUI are used,
+        so GUI is in the same state as if user clicked them.
+        @param action str
+        @raise ValueError when action is unknown or not possible now
+        """
+        scheduler = self.scheduler
+
+        if action == 'start':
+            if scheduler.running:
+                return
+            if not scheduler.has_tasks():
+                raise ValueError('no task to schedule')
+            self.gui.start_stop_button.clicked()
+        elif action == 'cancel':
+            if scheduler.running:
+                self.gui.start_stop_button.clicked()
+        elif action in ('pause', 'resume'):
+            if not scheduler.running:
+                raise ValueError('conversion is not running')
+            if scheduler.paused != (action == 'pause'):
+                self.gui.pause_button.clicked()
+        else:
+            raise ValueError('unknown action: %s' % action)
+
+        self.logger.info('Scheduler action: %s', action)
+
+
+class TasksResource(resource.Resource):
+    """
+    Resource of tasks in queue.
+    """
+    def __init__(self, control):
+        resource.Resource.__init__(self)
+        self.control = control
+
+    def getChild(self, name, request):
+        try:
+            return TaskResource(self.control, int(name))
+        except ValueError:
+            return resource.NoResource()
+
+    def render_GET(self, request):
+        return json_response(request, {'tasks': self.control.get_tasks()})
+
+    def render_POST(self, request):
+        try:
+            data = read_json(request)
+            ids = self.control.submit(data.get('jobs'))
+            if data.get('start'):
+                self.control.control_scheduler('start')
+        except ValueError as e:
+            return error_response(request, 400, str(e))
+
+        return json_response(request, {'ids': ids}, 201)
+
+
+class TaskResource(resource.Resource):
+    """
+    Resource of one task.
+    """
+    isLeaf = True
+
+    def __init__(self, control, row_id):
+        resource.Resource.__init__(self)
+        self.control = control
+        self.row_id = row_id
+
+    def render_GET(self, request):
+        task = self.control.get_task(self.row_id)
+        if task is None:
+            return error_response(request, 404, 'unknown task')
+
+        return json_response(request, task)
+
+    def render_POST(self, request):
+        try:
+            priority = read_json(request).get('priority')
+            check_priority(priority)
+        except ValueError as e:
+            return error_response(request, 400, str(e))
+
+        if not self.control.scheduler.set_task_priority(self.row_id,
+                                                        priority):
+            return error_response(request, 404, 'unknown task')
+
+        return json_response(request, self.control.get_task(self.row_id))
+
+    def render_DELETE(self, request):
+        if not self.control.scheduler.cancel_task(self.row_id):
+            return error_response(request, 404, 'unknown task')
+
+        return json_response(request, self.control.get_task(self.row_id))
+
+
+class SchedulerResource(resource.Resource):
+    """
+    Resource of scheduler.
+    """
+    isLeaf = True
+
+    def __init__(self, control):
+        resource.Resource.__init__(self)
+        self.control = control
+
+    def render_GET(self, request):
+        return json_response(request, self.control.get_scheduler_state())
+
+    def render_POST(self, request):
+        try:
+            action = read_json(request).get('action')
+            self.control.control_scheduler(action)
+        except ValueError as e:
+            return error_response(request, 400, str(e))
+
+        return json_response(request, self.control.get_scheduler_state())
+
+
+class EventsResource(resource.Resource):
+    """
+    Resource streaming events of scheduler. Each event is written as one line
+    with JSON object until client closes connection.
+    """
+    isLeaf = True
+
+    def __init__(self, control):
+        resource.Resource.__init__(self)
+        self.control = control
+
+    def render_GET(self, request):
+        scheduler = self.control.scheduler
+
+        request.setHeader('Content-Type', 'application/x-ndjson')
+
+        def write_event(event):
+            request.write(json.dumps(event) + '\n')
+
+        scheduler.add_listener(write_event)
+
+        finished = request.notifyFinish()
+        finished.addBoth(lambda _: scheduler.remove_listener(write_event))
+
+        return server.NOT_DONE_YET
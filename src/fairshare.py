@@ -0,0 +1,224 @@
+# -*- coding: utf8 -*-
+"""
+Provides class used to share converter between several named queues.
+"""
+
+import logging
+import time
+
+from config import Configuration
+
+
+class QueueStats(object):
+    """
+    Simple structure that keeps state and statistics of named queue.
+    """
+    name = None
+    weight = 1
+    limit = 0
+    pass_value = 0.0
+    active = False
+    running = 0
+    started = 0
+    finished = 0
+    succeeded = 0
+    wait_time = 0.0
+    max_wait_time = 0.0
+    run_time = 0.0
+    media_time = 0.0
+
+    def __str__(self):
+        return "<Queue '%s'>" % self.name
+
+
+class FairShare(object):
+    """
+    Class that shares slots of scheduler between named queues by weighted
+    round-robin (stride scheduling): each queue has pass value that is
+    increased by 1 / weight whenever task of the queue is started. Waiting
+    tasks with the same priority are ordered by pass value of their queues,
+    so queue with weight 3 starts three tasks while queue with weight 1
+    starts one. Queue that becomes active again doesn't get credit for time
+    when it was idle.
+
+    Class implements interface of admission controls too, task is not
+    admitted when its queue reached its concurrency cap. Statistics of wait
+    time and throughput of each queue are collected and logged.
+    """
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = Configuration()
+
+        self.default_queue = self.config.get('queues', 'default_queue')
+        self.weights = self.parse_values(self.config.get('queues', 'weights'))
+        self.limits = self.parse_values(self.config.get('queues', 'limits'))
+        self.logger.debug('Queue weights: %s, limits: %s', self.weights,
+                          self.limits)
+
+        self.queues = {}
+        self.running_tasks = set()
+        self.start_time = time.time()
+
+    def parse_values(self, values_str):
+        """
+        Parse values in format 'queue=value; queue=value'.
+        @param values_str str
+        @return dict, Map of queue name to int value
+        """
+        values = {}
+
+        for item in values_str.split(';'):
+            if not item.strip():
+                continue
+
+            name, sep, value = item.rpartition('=')
+            try:
+                values[name.strip()] = int(value)
+            except ValueError:
+                self.logger.warning('Invalid queue setting: %s', item)
+
+        return values
+
+    def get_queue_names(self):
+        """
+        @return list, Names of configured queues, default queue is first
+        """
+        names = sorted((set(self.weights) | set(self.limits))
+                       - set([self.default_queue]))
+        return [self.default_queue] + names
+
+    def get_queue(self, name):
+        """
+        Return state of queue, create new one when used first time.
+        @param name str or None, Name of queue, None means default queue
+        @return QueueStats
+        """
+        if not name:
+            name = self.default_queue
+
+        if name not in self.queues:
+            queue = QueueStats()
+            queue.name = name
+            queue.weight = max(1, self.weights.get(name, 1))
+            queue.limit = self.limits.get(name, 0)
+            self.queues[name] = queue
+
+        return self.queues[name]
+
+    def reset(self):
+        """
+        Reset pass values and statistics of all queues.
+        """
+        self.queues.clear()
+        self.running_tasks.clear()
+        self.start_time = time.time()
+
+    def sort_rows(self, rows):
+        """
+        Sort rows with the same priority by pass values of their queues. Order
+        of rows from the same queue is kept.
+        @param rows list, List of rows (type QueueRow) sorted by priority
+        @return list
+        """
+        active = set(self.get_queue(row['queue']) for row in rows)
+        active.update(queue for queue in self.queues.itervalues()
+                      if queue.running)
+
+        # queue which was idle starts with the lowest pass of active queues
+        previously_active = [queue for queue in active if queue.active]
+        if previously_active:
+            min_pass = min(queue.pass_value for queue in previously_active)
+            for queue in active:
+                if not queue.active:
+                    queue.pass_value = max(queue.pass_value, min_pass)
+
+        for queue in self.queues.itervalues():
+            queue.active = queue in active
+
+        def key(row):
+            return (-row['priority'], self.get_queue(row['queue']).pass_value)
+
+        return sorted(rows, key=key)
+
+    def admit(self, task):
+        """
+        @param task Task
+        @return bool, True if queue of task didn't reach its concurrency cap
+        """
+        queue = self.get_queue(task.queue)
+        if queue.limit > 0 and queue.running >= queue.limit:
+            self.logger.debug('%s reached its limit (%d)', queue, queue.limit)
+            return False
+
+        return True
+
+    def task_started(self, task):
+        self.running_tasks.add(task)
+
+        queue = self.get_queue(task.queue)
+        queue.pass_value += 1.0 / queue.weight
+        queue.running += 1
+        queue.started += 1
+
+        if task.queued_at:
+            wait_time = max(0.0, time.time() - task.queued_at)
+            queue.wait_time += wait_time
+            queue.max_wait_time = max(queue.max_wait_time, wait_time)
+
+    def task_finished(self, task):
+        if task not in self.running_tasks:
+            return  # slot of stalled task was already released
+
+        self.running_tasks.remove(task)
+
+        queue = self.get_queue(task.queue)
+        queue.running -= 1
+        queue.finished += 1
+
+        process = task.process
+        queue.run_time += process.get_run_time()
+
+        if process.returncode == 0 and not task.stalled:
+            queue.succeeded += 1
+            if task.media_info and task.media_info.duration:
+                queue.media_time += task.media_info.duration
+
+    def get_stats(self):
+        """
+        Return statistics of queues.
+        @return list, List of dicts sorted by queue name
+        """
+        elapsed_hours = max(time.time() - self.start_time, 1.0) / 3600
+
+        stats = []
+        for name in sorted(self.queues):
+            queue = self.queues[name]
+            started = max(queue.started, 1)
+            stats.append({'queue': name,
+                          'weight': queue.weight,
+                          'limit': queue.limit,
+                          'running': queue.running,
+                          'started': queue.started,
+                          'finished': queue.finished,
+                          'succeeded': queue.succeeded,
+                          'avg_wait_time': queue.wait_time / started,
+                          'max_wait_time': queue.max_wait_time,
+                          'run_time': queue.run_time,
+                          'tasks_per_hour': queue.succeeded / elapsed_hours,
+                          'media_hours_per_hour':
+                              queue.media_time / 3600 / elapsed_hours})
+
+        return stats
+
+    def log_stats(self):
+        """
+        Log statistics of all queues.
+        """
+        for stats in self.get_stats():
+            self.logger.info('Queue %(queue)s (weight %(weight)d, limit '
+                             '%(limit)d): %(succeeded)d/%(finished)d tasks '
+                             'done, wait avg %(avg_wait_time).0f s, max '
+                             '%(max_wait_time).0f s, %(tasks_per_hour).1f '
+                             'tasks/h, %(media_hours_per_hour).2f h of '
+                             'media/h', stats)
@@ -20,14 +20,17 @@ else:
 import logging
 import os
 import os.path
-from datetime import datetime
+import time
 
 from twisted.internet import defer, reactor
 
 from config import Configuration
+from control import ControlServer
+from probe import MediaProber
+from profiling import Instrumentation, timed
 from scheduler import Queue, Scheduler
-from utils import (get_install_dir, get_app_dir, get_version, setup_logging,
-                   async_function, encode, cached_property)
+from utils import (get_install_dir, get_version, setup_logging,
+                   async_function, cached_property)
 
 
 class VideoConvertorGUI(object):
@@ -36,6 +39,7 @@ class VideoConvertorGUI(object):
     independent scheduler that takes tasks from queue and starts processes.
     """
     last_row_id = 0
+    drag_target = 'VIDEOCONVERTOR_ROWS'
 
     def __init__(self):
         """
@@ -48,11 +52,21 @@ class VideoConvertorGUI(object):
 
         self.config = Configuration()
 
+        self.instrumentation = Instrumentation()
+        self.instrumentation.start()
+
         self._init_ui()
 
         self.tasks_queue = Queue(self.tasks_liststore)
         self.scheduler = Scheduler(self.tasks_queue)
 
+        self._init_throttle_widgets()
+        self._init_priority_widgets()
+        self._init_queue_widgets()
+
+        self.control_server = ControlServer(self)
+        self.control_server.start()
+
     def _init_ui(self):
         """
         Build main window from xml, connect signals and bind window's widgets
@@ -71,11 +85,22 @@ class VideoConvertorGUI(object):
                    'on_remove_subtitles_button_clicked': self.on_remove_subtitles_button_clicked,
                    'on_up_button_clicked': self.on_up_button_clicked,
                    'on_down_button_clicked': self.on_down_button_clicked,
+                   'on_top_button_clicked': self.on_top_button_clicked,
+                   'on_bottom_button_clicked': self.on_bottom_button_clicked,
+                   'on_sort_name_button_clicked': self.on_sort_name_button_clicked,
+                   'on_sort_size_button_clicked': self.on_sort_size_button_clicked,
+                   'on_sort_duration_button_clicked': self.on_sort_duration_button_clicked,
                    'on_start_stop_button_clicked': self.on_start_stop_button_clicked,
-                   'on_pause_button_clicked': self.on_pause_button_clicked}
+                   'on_pause_button_clicked': self.on_pause_button_clicked,
+                   'on_priority_combobox_changed': self.on_priority_combobox_changed,
+                   'on_throttle_checkbutton_toggled': self.on_throttle_settings_changed,
+                   'on_throttle_spinbutton_value_changed': self.on_throttle_settings_changed}
+        signals = dict((name, timed('VideoConvertorGUI.' + name)(handler))
+                       for name, handler in signals.iteritems())
         builder.connect_signals(signals)
 
         self._set_widget_objects(builder)
+        self._init_drag_and_drop()
 
         version = get_version()
 
@@ -95,16 +120,72 @@ class VideoConvertorGUI(object):
         @param builder gtk.Builder
         '''
         widgets = ('add_file_button', 'remove_file_button', 'up_button',
-                   'down_button', 'files_treeview', 'tasks_liststore',
+                   'down_button', 'top_button', 'bottom_button',
+                   'files_treeview', 'tasks_liststore',
                    'subtitles_entry', 'add_subtitles_button',
                    'remove_subtitles_button',
                    'start_stop_button', 'pause_button', 'spinner',
                    'play_image', 'stop_image', 'subpix_image',
-                   'main_window')
+                   'throttle_checkbutton', 'throttle_spinbutton',
+                   'priority_combobox', 'priorities_liststore',
+                   'priority_column', 'priority_view', 'queue_combobox',
+                   'queues_liststore', 'main_window')
         go = builder.get_object
         for widget_name in widgets:
             setattr(self, widget_name, go(widget_name))
 
+    def _init_drag_and_drop(self):
+        '''
+        Allow to move rows of queue by drag and drop.
+        '''
+        targets = [(self.drag_target, gtk.TARGET_SAME_WIDGET, 0)]
+        self.files_treeview.enable_model_drag_source(gtk.gdk.BUTTON1_MASK,
+                                                     targets,
+                                                     gtk.gdk.ACTION_MOVE)
+        self.files_treeview.enable_model_drag_dest(targets,
+                                                   gtk.gdk.ACTION_MOVE)
+        self.files_treeview.connect('drag-data-get',
+                                    self.on_files_treeview_drag_data_get)
+        self.files_treeview.connect('drag-data-received',
+                                    self.on_files_treeview_drag_data_received)
+
+    def _init_throttle_widgets(self):
+        '''
+        Show throttling settings of scheduler.
+        '''
+        cpu_target = self.scheduler.throttle.cpu_target
+        enabled = cpu_target is not None
+
+        if not enabled:
+            cpu_target = self.config.getint('throttle', 'cpu_target')
+
+        self.throttle_spinbutton.set_value(cpu_target)
+        self.throttle_spinbutton.set_sensitive(enabled)
+        self.throttle_checkbutton.set_active(enabled)
+
+    def _init_priority_widgets(self):
+        '''
+        Show names of priorities in queue.
+        '''
+        self.priority_names = dict((row[1], row[0])
+                                   for row in self.priorities_liststore)
+
+        def render_priority(column, cell, model, iter_):
+            priority = model.get_value(iter_, self._get_column_no('priority'))
+            cell.set_property('text', self.priority_names.get(priority, ''))
+
+        self.priority_column.set_cell_data_func(self.priority_view,
+                                                render_priority)
+
+    def _init_queue_widgets(self):
+        '''
+        Fill names of configured queues, new files are added to default one.
+        '''
+        for queue_name in self.scheduler.fairshare.get_queue_names():
+            self.queues_liststore.append((queue_name,))
+
+        self.queue_combobox.set_active(0)
+
     def main(self):
         """
         Run GTK application - start reactor.
@@ -174,10 +255,16 @@ class VideoConvertorGUI(object):
         for file_name in file_names:
             self.add_file_name(file_name)
 
-    def add_file_name(self, file_name):
+    def add_file_name(self, file_name, queue_name=None, priority=None,
+                      sub_file_name=None):
         """
         Create valid datarow and append it to queue.
         @param file_name str, Name of file to append
+        @param queue_name str, Name of queue, None means queue chosen in
+            combobox
+        @param priority int, Priority of task, None means default priority
+        @param sub_file_name str, Name of subtitles file
+        @return int, ID of new row
         """
         self.logger.debug('Appending file: %s', file_name)
 
@@ -186,9 +273,21 @@ class VideoConvertorGUI(object):
         row_id = self.last_row_id
         self.last_row_id += 1
 
-        datarow = (row_id, file_name, None, False, pixbuf, False)
+        if priority is None:
+            priority = self.config.getint('scheduler', 'default_priority')
+
+        if queue_name is None:
+            active = self.queue_combobox.get_active()
+            queue_name = self.queues_liststore[active][0]
+
+        has_sub = sub_file_name is not None
+
+        datarow = (row_id, file_name, sub_file_name, has_sub, pixbuf, False,
+                   priority, queue_name, time.time())
         self.tasks_queue.append(datarow)
 
+        return row_id
+
     def get_image_pixbuf(self, stock_id):
         """
         Get pixbuf of stock-image.
@@ -285,10 +384,14 @@ class VideoConvertorGUI(object):
         self.remove_file_button.set_sensitive(selected)
         self.up_button.set_sensitive(selected)
         self.down_button.set_sensitive(selected)
+        self.top_button.set_sensitive(selected)
+        self.bottom_button.set_sensitive(selected)
         self.add_subtitles_button.set_sensitive(selected)
         self.remove_subtitles_button.set_sensitive(selected)
+        self.priority_combobox.set_sensitive(selected)
 
         yield self.set_subtitles_entry()
+        yield self.set_priority_combobox()
 
     @defer.inlineCallbacks
     def set_conversion_running(self, set_running):
@@ -314,12 +417,17 @@ class VideoConvertorGUI(object):
         Remove selected files.
         @return t.i.d.Deferred
         """
-        rows = yield self.get_selected_rows()
+        paths = yield self.get_selected_paths()
+
+        if not paths:
+            return
+
         column = self._get_column_no('file_path')
-        for row in rows:
-            self.logger.debug('Removing file: %s', row[column])
+        for path in paths:
+            self.logger.debug('Removing file: %s',
+                              self.tasks_liststore[path][column])
 
-            self.tasks_queue.remove(row)
+        self.tasks_queue.remove_paths(paths)
 
     @defer.inlineCallbacks
     def on_add_subtitles_button_clicked(self, widget, *data):
@@ -379,6 +487,52 @@ class VideoConvertorGUI(object):
             else:
                 self.subtitles_entry.set_text('')
 
+    @defer.inlineCallbacks
+    def set_priority_combobox(self):
+        """
+        Show priority of selected rows. Reset combobox if no row is selected
+        or selected rows have different priorities.
+        @return t.i.d.Deferred
+        """
+        rows = yield self.get_selected_rows()
+
+        column = self._get_column_no('priority')
+        priorities = set(row[column] for row in rows)
+
+        active = -1
+        if len(priorities) == 1:
+            priority = priorities.pop()
+            for i, row in enumerate(self.priorities_liststore):
+                if row[1] == priority:
+                    active = i
+
+        self.priority_combobox.set_active(active)
+
+    @defer.inlineCallbacks
+    def on_priority_combobox_changed(self, widget, *data):
+        """
+        Set chosen priority to selected rows. When conversion is running,
+        reschedule immediately, so urgent task could preempt running ones.
+        @return t.i.d.Deferred
+        """
+        active = self.priority_combobox.get_active()
+        if active < 0:
+            return
+
+        priority = self.priorities_liststore[active][1]
+
+        rows = yield self.get_selected_rows()
+
+        column = self._get_column_no('priority')
+        changed = [row for row in rows if row[column] != priority]
+
+        # scheduler updates also tasks of running rows and reschedules
+        for row in changed:
+            self.logger.debug('Setting priority %s to %s', priority,
+                              row[self._get_column_no('file_path')])
+            self.scheduler.set_task_priority(row[self._get_column_no('id')],
+                                             priority)
+
     @defer.inlineCallbacks
     def on_remove_subtitles_button_clicked(self, widget, *data):
         """
@@ -405,53 +559,206 @@ class VideoConvertorGUI(object):
         """
         paths = yield self.get_selected_paths()
 
-        if len(paths) == 0:
+        if not paths:
             return
 
-        model = self.tasks_liststore
+        positions = [path[0] for path in paths]
+        self.reorder_queue(self.get_shifted_order(positions, -1))
 
-        selection = self.files_treeview.get_selection()
+    @defer.inlineCallbacks
+    def on_down_button_clicked(self, widget, *data):
+        """
+        Move selected rows down in queue.
+        @return t.i.d.Deferred
+        """
+        paths = yield self.get_selected_paths()
 
-        for path in paths:
-            row = path[0]
-            if row > 0:
-                this = tuple(model[row])
-                prev = tuple(model[row-1])
-                model[row-1] = this
-                model[row] = prev
+        if not paths:
+            return
 
-                selection.unselect_path(row)
-                selection.select_path(row-1)
+        positions = [path[0] for path in paths]
+        self.reorder_queue(self.get_shifted_order(positions, 1))
 
     @defer.inlineCallbacks
-    def on_down_button_clicked(self, widget, *data):
+    def on_top_button_clicked(self, widget, *data):
         """
-        Move selected rows down in queue.
+        Move selected rows to the top of queue.
         @return t.i.d.Deferred
         """
         paths = yield self.get_selected_paths()
 
-        if len(paths) == 0:
+        if not paths:
             return
 
-        model = self.tasks_liststore
-        row_count = len(model)
+        positions = [path[0] for path in paths]
+        self.reorder_queue(self.get_moved_order(positions, 0))
 
-        selection = self.files_treeview.get_selection()
+    @defer.inlineCallbacks
+    def on_bottom_button_clicked(self, widget, *data):
+        """
+        Move selected rows to the bottom of queue.
+        @return t.i.d.Deferred
+        """
+        paths = yield self.get_selected_paths()
 
-        # we have to move bottom row first
-        paths = reversed(sorted(paths))
+        if not paths:
+            return
 
-        for path in paths:
-            row = path[0]
-            if row < row_count - 1:
-                this = tuple(model[row])
-                next = tuple(model[row+1])
-                model[row+1] = this
-                model[row] = next
+        positions = [path[0] for path in paths]
+        target = len(self.tasks_liststore) - len(positions)
+        self.reorder_queue(self.get_moved_order(positions, target))
 
-                selection.unselect_path(row)
-                selection.select_path(row+1)
+    def on_files_treeview_drag_data_get(self, widget, context, selection_data,
+                                        info, time):
+        """
+        Rows are moved inside of treeview, so only mark data as valid.
+        """
+        widget.emit_stop_by_name('drag-data-get')
+        selection_data.set(self.drag_target, 8, '')
+
+    def on_files_treeview_drag_data_received(self, widget, context, x, y,
+                                             selection_data, info, time):
+        """
+        Move selected rows to the drop position.
+        """
+        widget.emit_stop_by_name('drag-data-received')
+
+        model, paths = widget.get_selection().get_selected_rows()
+        positions = [path[0] for path in paths]
+
+        drop_info = widget.get_dest_row_at_pos(x, y)
+        if drop_info is None:
+            drop_row = len(model)
+        else:
+            path, position = drop_info
+            drop_row = path[0]
+            if position in (gtk.TREE_VIEW_DROP_AFTER,
+                            gtk.TREE_VIEW_DROP_INTO_OR_AFTER):
+                drop_row += 1
+
+        if positions:
+            # target position in queue without moved rows
+            target = drop_row - len([p for p in positions if p < drop_row])
+            self.reorder_queue(self.get_moved_order(positions, target))
+
+        context.finish(True, False, time)
+
+    def get_shifted_order(self, positions, step):
+        """
+        Return permutation that shifts rows on given positions by one step
+        up (-1) or down (1). Block of rows stops at the edge of queue.
+        @param positions list, Positions of rows to shift
+        @param step int, -1 or 1
+        @return list
+        """
+        order = range(len(self.tasks_liststore))
+        selected = set(positions)
+
+        # when moving down we have to move bottom row first
+        for position in sorted(selected, reverse=(step > 0)):
+            neighbour = position + step
+            if 0 <= neighbour < len(order) and order[neighbour] not in selected:
+                order[position], order[neighbour] = (order[neighbour],
+                                                     order[position])
+
+        return order
+
+    def get_moved_order(self, positions, target):
+        """
+        Return permutation that moves rows on given positions to the target
+        position. Mutual order of moved rows is preserved.
+        @param positions list, Positions of rows to move
+        @param target int, Position in queue without moved rows
+        @return list
+        """
+        moved = sorted(set(positions))
+        selected = set(moved)
+        others = [position for position in range(len(self.tasks_liststore))
+                  if position not in selected]
+
+        return others[:target] + moved + others[target:]
+
+    def reorder_queue(self, new_order):
+        """
+        Reorder queue by one permutation. Selection follows moved rows.
+        @param new_order list, Old positions of rows in their new order
+        """
+        if new_order == range(len(new_order)):
+            return
+
+        self.logger.debug('Reordering queue')
+        self.tasks_queue.reorder(new_order)
+
+    def sort_queue(self, keys):
+        """
+        Sort queue by keys of files. Rows with unknown key are moved to the
+        bottom. If queue is already sorted, sort it in descending order.
+        @param keys dict, Map of file path to sort key or None
+        """
+        column = self._get_column_no('file_path')
+        values = [keys.get(row[column]) for row in self.tasks_liststore]
+
+        known = [i for i, value in enumerate(values) if value is not None]
+        unknown = [i for i, value in enumerate(values) if value is None]
+
+        known.sort(key=lambda i: values[i])
+        if known + unknown == range(len(values)):
+            known.sort(key=lambda i: values[i], reverse=True)
+
+        self.reorder_queue(known + unknown)
+
+    def get_queued_file_names(self):
+        """
+        @return list, File names of all rows in queue
+        """
+        column = self._get_column_no('file_path')
+        return [row[column] for row in self.tasks_liststore]
+
+    def on_sort_name_button_clicked(self, widget, *data):
+        """
+        Sort queue by name of files.
+        """
+        keys = dict((file_name, os.path.basename(file_name).lower())
+                    for file_name in self.get_queued_file_names())
+        self.sort_queue(keys)
+
+    @defer.inlineCallbacks
+    def on_sort_size_button_clicked(self, widget, *data):
+        """
+        Sort queue by size of files.
+        @return t.i.d.Deferred
+        """
+        keys = yield self.get_file_sizes(self.get_queued_file_names())
+        self.sort_queue(keys)
+
+    @defer.inlineCallbacks
+    def on_sort_duration_button_clicked(self, widget, *data):
+        """
+        Sort queue by duration of videos. Files are probed when their duration
+        is not known yet.
+        @return t.i.d.Deferred
+        """
+        prober = MediaProber()
+        infos = yield defer.gatherResults([prober.probe(file_name)
+                                           for file_name
+                                           in self.get_queued_file_names()])
+        keys = dict((info.file_path, info.duration) for info in infos)
+        self.sort_queue(keys)
+
+    @async_function
+    def get_file_sizes(self, file_names):
+        """
+        Return sizes of files. Size of inaccessible file is None.
+        @param file_names list
+        @return t.i.d.Deferred, dict, Map of file name to size
+        """
+        sizes = {}
+        for file_name in file_names:
+            try:
+                sizes[file_name] = os.stat(file_name).st_size
+            except OSError:
+                sizes[file_name] = None
+        return sizes
 
     @defer.inlineCallbacks
     def on_start_stop_button_clicked(self, widget, *data):
@@ -486,6 +793,20 @@ class VideoConvertorGUI(object):
             self.logger.debug('Resuming conversion')
             yield self.set_conversion_paused(False)
 
+    def on_throttle_settings_changed(self, widget, *data):
+        """
+        Set CPU target of scheduler according to throttling widgets.
+        """
+        enabled = self.throttle_checkbutton.get_active()
+        self.throttle_spinbutton.set_sensitive(enabled)
+
+        cpu_target = None
+        if enabled:
+            cpu_target = self.throttle_spinbutton.get_value_as_int()
+
+        if cpu_target != self.scheduler.throttle.cpu_target:
+            self.scheduler.set_cpu_target(cpu_target)
+
     @defer.inlineCallbacks
     def start_conversion(self):
         """
@@ -498,7 +819,7 @@ class VideoConvertorGUI(object):
 
             yield self.scheduler.start()
 
-            yield self.show_report_and_log_errors()
+            self.show_report()
 
         finally:
             yield self.set_conversion_running(False)
@@ -521,30 +842,25 @@ class VideoConvertorGUI(object):
         else:
             self.scheduler.resume()
 
-    @defer.inlineCallbacks
-    def show_report_and_log_errors(self):
+    def show_report(self):
         """
-        If tasks were finished with done status, show info dialog.
-        If tasks were finished with failed or incomplete status, show error
-        dialog with complete report and store error log.
-        @return t.i.d.Deferred
+        If all tasks were finished with done status, show info dialog.
+        If some tasks were finished with failed or incomplete status, show
+        error dialog with report. Results of tasks are already stored in
+        results log.
         """
-        if not self.scheduler.tasks_failed and not self.scheduler.tasks_incomplete:
-            msg = 'Úspěšně dokončeno %d úloh.' % len(self.scheduler.tasks_done)
+        results = self.scheduler.results
+
+        if not results.problems_count:
+            msg = 'Úspěšně dokončeno %d úloh.' % results.counts['done']
             self.show_info_dialog(msg)
         else:
-            error_log_name = 'MencoderErrors_%s.log' % datetime.now()
-            # colon is not allowed in windows path
-            error_log_name = error_log_name.replace(':', '-')
-
-            yield self.write_error_log(error_log_name)
-
             message_template = '''
 Úspěšně dokončeno %d úloh, selhalo %d úloh a %d úloh je nekompletních.
 
 Nekompletně dokončené úlohy mohou mít poškozený vstupní soubor!
 
-Chybové výstupy byly uloženy do logu %s.
+Výsledky úloh včetně chybových výstupů byly uloženy do logu %s.
 
 ===================================================
 
@@ -557,17 +873,22 @@ Nekompletní úlohy:
 %s
 '''
 
-            tasks_failed = '\n'.join([task.input_file
-                                      for task in self.scheduler.tasks_failed])
-            tasks_incomplete = '\n'.join([task.input_file
-                                          for task in self.scheduler.tasks_incomplete])
+            def format_files(status):
+                files = results.reported[status]
+                text = '\n'.join(files)
+
+                omitted = results.counts[status] - len(files)
+                if omitted > 0:
+                    text += '\n... a dalších %d úloh' % omitted
 
-            message = message_template % (len(self.scheduler.tasks_done),
-                                          len(self.scheduler.tasks_failed),
-                                          len(self.scheduler.tasks_incomplete),
-                                          error_log_name,
-                                          tasks_failed,
-                                          tasks_incomplete)
+                return text
+
+            message = message_template % (results.counts['done'],
+                                          results.counts['failed'],
+                                          results.counts['incomplete'],
+                                          results.file_path,
+                                          format_files('failed'),
+                                          format_files('incomplete'))
 
             self.show_error_dialog(message)
 
@@ -584,49 +905,10 @@ Nekompletní úlohy:
         dialog.run()
         dialog.destroy()
 
-    @async_function
-    def write_error_log(self, log_name):
-        """
-        Write errorlog file.
-        @param log_name str, Path to log file
-        @return t.i.d.Deferred
-        """
-
-        def format_task(task):
-            return ('Task: input_file="%s", sub_file="%s", output_file="%s"'
-                    % (task.input_file, task.sub_file, task.output_file))
-
-        def write_section(f, section_title, tasks):
-            record_template = '{0}\n\nreturncode:{1}\n\n\n{2}'
-            data = (record_template.format(format_task(task),
-                                           task.process.returncode,
-                                           task.process.stderr)
-                    for task in tasks)
-
-            msg = '\n>>>>>> {0}\n\n\n'.format(section_title)
-
-            separator = '\n\n\n------------------------------------------\n\n\n'
-            msg += separator.join(data)
-
-            f.write(encode(msg))
-
-        try:
-            log_dir_path = os.path.join(get_app_dir(), 'log')
-            log_file_path = os.path.join(log_dir_path, log_name)
-
-            if not os.path.exists(log_dir_path):
-                os.mkdir(log_dir_path)
-
-            with file(log_file_path, 'a') as f:
-                write_section(f, 'FAILED TASKS', self.scheduler.tasks_failed)
-                write_section(f, 'INCOMPLETE TASKS', self.scheduler.tasks_incomplete)
-        except:
-            import traceback
-            self.logger.critical(traceback.format_exc())
-
     def _get_column_no(self, column):
         column_no = {'id': 0,  'file_path': 1, 'sub_path': 2, 'has_sub': 3,
-                     'subpix': 4, 'running': 5}[column]
+                     'subpix': 4, 'running': 5, 'priority': 6, 'queue': 7,
+                     'queued_at': 8}[column]
         return column_no
 
 
@@ -0,0 +1,292 @@
+# -*- coding: utf8 -*-
+"""
+Provides class used to record history of conversions and to predict time of
+conversion from it.
+"""
+
+import hashlib
+import logging
+import math
+import os.path
+import socket
+import sqlite3
+import sys
+import time
+
+from twisted.internet import defer
+
+from config import Configuration
+from utils import singleton, async_function, get_app_dir
+
+
+class EncodeSample(object):
+    """
+    Simple structure that keeps characteristics of input of finished task and
+    achieved speed of conversion.
+    """
+    host = None
+    file_size = None
+    duration = None
+    width = None
+    height = None
+    video_format = None
+    video_bitrate = None
+    run_time = None
+    fps = None
+
+    @property
+    def speed(self):
+        """
+        @return float, Seconds of media converted per second
+        """
+        return self.duration / self.run_time
+
+
+@singleton
+class EncodeHistory(object):
+    """
+    Singleton class that records every successfully converted file to SQLite
+    database in application's directory: characteristics of input (duration,
+    resolution, codec, size), hash of conversion profile, host and achieved
+    speed. Files whose streams were copied are not recorded, their speed says
+    nothing about conversion.
+
+    Samples of current profile are kept in memory, so run time of file could
+    be predicted without blocking: speed of conversion is estimated as
+    weighted average of the most similar samples (k nearest neighbours by
+    resolution, bitrate and codec), samples from this host are preferred.
+    Database is accessed in worker threads.
+    """
+    columns = ('finished_at', 'host', 'profile', 'input_file', 'file_size',
+               'duration', 'width', 'height', 'video_format',
+               'video_bitrate', 'run_time', 'frames', 'fps')
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = Configuration()
+
+        self.enabled = self.config.getboolean('history', 'enabled')
+        self.neighbours = self.config.getint('history', 'neighbours')
+        self.file_path = os.path.join(get_app_dir(),
+                                      self.config.get('history', 'filename'))
+
+        self.host = socket.gethostname()
+        self.profile = self.get_profile_hash()
+        self.samples = []
+        self.loaded = False
+
+    def get_profile_hash(self):
+        """
+        Return hash of conversion command patterns, so samples of different
+        conversion settings are not mixed.
+        @return str
+        """
+        if sys.platform in ('win32', 'cygwin'):
+            convertor_exe = self.config.get('command', 'convertor_exe_win')
+        else:
+            convertor_exe = self.config.get('command', 'convertor_exe_unix')
+
+        options = ('backend', 'convertor_args', 'subtitle_params',
+                   'video_params', 'audio_params', 'max_resolution',
+                   'bitrate_tiers')
+        profile = '\n'.join([os.path.basename(convertor_exe)] +
+                             [self.config.get('command', option)
+                              for option in options])
+        return hashlib.sha1(profile).hexdigest()[:16]
+
+    def connect(self):
+        """
+        Open database and create its table when needed.
+        @return sqlite3.Connection
+        """
+        connection = sqlite3.connect(self.file_path, timeout=30)
+        connection.execute('CREATE TABLE IF NOT EXISTS encodes ('
+                           'id INTEGER PRIMARY KEY, finished_at REAL, '
+                           'host TEXT, profile TEXT, input_file TEXT, '
+                           'file_size INTEGER, duration REAL, width INTEGER, '
+                           'height INTEGER, video_format TEXT, '
+                           'video_bitrate INTEGER, run_time REAL, '
+                           'frames INTEGER, fps REAL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS encodes_profile '
+                           'ON encodes (profile)')
+        return connection
+
+    @defer.inlineCallbacks
+    def load(self):
+        """
+        Load samples of current profile from database. Loading is done only
+        once.
+        @return t.i.d.Deferred
+        """
+        if not self.enabled or self.loaded:
+            return
+
+        try:
+            samples = yield self.read_samples()
+        except Exception as e:
+            self.logger.error('Loading of encode history failed: %s', e)
+            return
+
+        self.samples = samples + self.samples
+        self.loaded = True
+        self.logger.info('Loaded %d samples of encode history', len(samples))
+
+    @async_function
+    def read_samples(self):
+        """
+        @return t.i.d.Deferred, list, Samples of current profile
+        """
+        connection = self.connect()
+        try:
+            rows = connection.execute(
+                'SELECT host, file_size, duration, width, height, '
+                'video_format, video_bitrate, run_time, fps FROM encodes '
+                'WHERE profile = ? AND duration > 0 AND run_time > 0',
+                (self.profile,)).fetchall()
+        finally:
+            connection.close()
+
+        samples = []
+        for row in rows:
+            sample = EncodeSample()
+            (sample.host, sample.file_size, sample.duration, sample.width,
+             sample.height, sample.video_format, sample.video_bitrate,
+             sample.run_time, sample.fps) = row
+            samples.append(sample)
+        return samples
+
+    def add(self, task):
+        """
+        Record successfully finished task. Task which copied streams is
+        skipped.
+        @param task Task
+        """
+        info = task.media_info
+        run_time = task.process.get_run_time()
+        if (not self.enabled or info is None or not info.duration
+                or run_time <= 0):
+            return
+
+        if task.process.video_copy or task.process.audio_copy:
+            self.logger.debug('Not recording %s, streams were copied', task)
+            return
+
+        sample = EncodeSample()
+        sample.host = self.host
+        sample.file_size = info.file_size
+        sample.duration = info.duration
+        sample.width = info.width
+        sample.height = info.height
+        sample.video_format = info.video_format
+        sample.video_bitrate = info.video_bitrate
+        sample.run_time = run_time
+        sample.fps = task.process.fps
+        self.samples.append(sample)
+
+        values = (time.time(), self.host, self.profile, task.input_file,
+                  info.file_size, info.duration, info.width, info.height,
+                  info.video_format, info.video_bitrate, run_time,
+                  task.process.frames, task.process.fps)
+        d = self.write_row(values)
+        d.addErrback(lambda fail: self.logger.error(
+            'Writing of encode history failed: %s', fail.getErrorMessage()))
+
+    @async_function
+    def write_row(self, values):
+        """
+        @param values tuple, Values of columns
+        """
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute(
+                    'INSERT INTO encodes (%s) VALUES (%s)'
+                    % (', '.join(self.columns),
+                       ', '.join('?' * len(self.columns))), values)
+        finally:
+            connection.close()
+
+    def get_distance(self, info, sample):
+        """
+        Return dissimilarity of input file and sample: difference of log of
+        pixel count and of log of video bitrate, different codec adds 1.
+        @param info MediaInfo
+        @param sample EncodeSample
+        @return float
+        """
+        def log_diff(a, b):
+            if not a and not b:
+                return 0.0
+            if not a or not b:
+                return 1.0
+            return abs(math.log(float(a) / b))
+
+        distance = 0.0
+        if info.width and info.height and sample.width and sample.height:
+            distance += log_diff(info.width * info.height,
+                                 sample.width * sample.height)
+        else:
+            distance += 1.0
+
+        distance += log_diff(info.video_bitrate, sample.video_bitrate)
+
+        if info.video_format != sample.video_format:
+            distance += 1.0
+
+        return distance
+
+    def get_host_samples(self):
+        """
+        @return list, Samples from this host or all samples when there is
+            none from this host
+        """
+        samples = [s for s in self.samples if s.host == self.host]
+        return samples or self.samples
+
+    def get_nearest_distance(self, info):
+        """
+        @param info MediaInfo
+        @return float or None, Distance of the most similar sample or None
+            when there is no sample
+        """
+        samples = self.get_host_samples()
+        if not samples:
+            return None
+
+        return min(self.get_distance(info, sample) for sample in samples)
+
+    def predict_speed(self, info):
+        """
+        Estimate speed of conversion of file from the nearest samples.
+        Samples from this host are used when there are any.
+        @param info MediaInfo
+        @return float or None, Seconds of media converted per second or None
+            when there is no sample
+        """
+        samples = self.get_host_samples()
+        if not samples:
+            return None
+
+        nearest = sorted((self.get_distance(info, sample), sample)
+                         for sample in samples)[:self.neighbours]
+
+        weights = [1.0 / (distance + 0.1) for distance, sample in nearest]
+        speeds = [sample.speed for distance, sample in nearest]
+        return sum(w * s for w, s in zip(weights, speeds)) / sum(weights)
+
+    def predict_run_time(self, info):
+        """
+        Estimate run time of conversion of file.
+        @param info MediaInfo or None
+        @return float or None, Time in seconds or None when it can't be
+            estimated
+        """
+        if not self.enabled or info is None or not info.duration:
+            return None
+
+        speed = self.predict_speed(info)
+        if not speed:
+            return None
+
+        return info.duration / speed
@@ -0,0 +1,172 @@
+# -*- coding: utf8 -*-
+"""
+Provides logging handler that doesn't block calling thread.
+"""
+
+import gzip
+import logging
+import os
+import os.path
+import shutil
+import sys
+import threading
+import Queue as queue
+
+
+class QueueHandler(logging.Handler):
+    """
+    Logging handler that only formats record and enqueues it. Records are
+    written by LogWriter thread, so reactor (GUI) thread never waits for
+    disk.
+    """
+    def __init__(self, records):
+        """
+        @param records Queue.Queue, Queue of formatted records
+        """
+        logging.Handler.__init__(self)
+        self.records = records
+
+    def emit(self, record):
+        try:
+            self.records.put_nowait(self.format(record) + '\n')
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+
+class LogWriter(threading.Thread):
+    """
+    Thread that writes formatted records from queue in batches to file or to
+    stdout. Log file is rotated when its size exceeds limit, rotated files
+    could be compressed by gzip.
+    """
+    batch_size = 256
+
+    def __init__(self, records, file_path=None, max_size=0, backup_count=0,
+                 compress=False):
+        """
+        @param records Queue.Queue, Queue of formatted records
+        @param file_path str, Path to log file, None means stdout
+        @param max_size int, Maximum size of log file in bytes, 0 disables
+            rotation
+        @param backup_count int, Count of rotated files to keep
+        @param compress bool, Compress rotated files by gzip
+        """
+        threading.Thread.__init__(self, name='LogWriter')
+        self.daemon = True
+
+        self.records = records
+        self.file_path = file_path
+        self.max_size = max_size
+        self.backup_count = backup_count
+        self.compress = compress
+
+        self.stream = None
+
+    def stop(self, timeout=5.0):
+        """
+        Write remaining records and stop thread.
+        @param timeout float, Maximum time to wait in seconds
+        """
+        self.records.put(None)
+        self.join(timeout)
+
+    def run(self):
+        self.open()
+
+        try:
+            while True:
+                batch = [self.records.get()]
+                try:
+                    while len(batch) < self.batch_size:
+                        batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    pass
+
+                stop = None in batch
+                self.write([record for record in batch if record is not None])
+
+                if stop:
+                    break
+        finally:
+            self.close()
+
+    def write(self, records):
+        """
+        Write batch of records and rotate file if needed.
+        @param records list, List of str
+        """
+        try:
+            self.stream.write(''.join(records))
+            self.stream.flush()
+
+            if self.should_rotate():
+                self.rotate()
+        except:
+            import traceback
+            traceback.print_exc(file=sys.stderr)
+
+    def open(self):
+        if self.file_path is None:
+            self.stream = sys.stdout
+        else:
+            self.stream = open(self.file_path, 'a')
+
+    def close(self):
+        if self.file_path is not None and self.stream is not None:
+            self.stream.close()
+        self.stream = None
+
+    def should_rotate(self):
+        """
+        @return bool, True if log file exceeded maximum size
+        """
+        if self.file_path is None or self.max_size <= 0:
+            return False
+
+        return self.stream.tell() >= self.max_size
+
+    def get_backup_path(self, number):
+        """
+        @param number int, Number of rotated file
+        @return str
+        """
+        path = '%s.%d' % (self.file_path, number)
+        if self.compress:
+            path += '.gz'
+        return path
+
+    def rotate(self):
+        """
+        Rename log file to first backup and shift older backups, the oldest
+        one is removed. Open new log file. When rotation fails, log file is
+        reopened anyway, so records are appended to current file.
+        """
+        self.close()
+
+        try:
+            if self.backup_count > 0:
+                for number in range(self.backup_count - 1, 0, -1):
+                    source = self.get_backup_path(number)
+                    if os.path.exists(source):
+                        destination = self.get_backup_path(number + 1)
+                        if os.path.exists(destination):
+                            os.remove(destination)
+                        os.rename(source, destination)
+
+                destination = self.get_backup_path(1)
+                if os.path.exists(destination):
+                    os.remove(destination)
+
+                if self.compress:
+                    with open(self.file_path, 'rb') as src:
+                        with gzip.open(destination, 'wb') as dst:
+                            shutil.copyfileobj(src, dst)
+                    os.remove(self.file_path)
+                else:
+                    os.rename(self.file_path, destination)
+            else:
+                os.remove(self.file_path)
+        finally:
+            self.open()
@@ -0,0 +1,153 @@
+# -*- coding: utf8 -*-
+"""
+Provides class used to protect system from memory pressure.
+"""
+
+import logging
+
+from twisted.internet import task as tx_task
+
+from config import Configuration
+
+
+class MemoryMonitor(object):
+    """
+    Class that watches available system memory and memory used by running
+    processes. It's used as admission control by scheduler: new tasks are not
+    admitted when available memory is below low watermark, unless no process
+    is running (memory is used by other programs then and waiting for it
+    could last forever). Under severe pressure (below severe watermark) the
+    most recently started process is suspended, one in each check. Suspended
+    processes are resumed one by one when available memory is above low
+    watermark again. Every decision is logged.
+    """
+    hold_reason = 'memory'
+
+    def __init__(self, processes):
+        """
+        Store set of processes to watch and set object's attributes.
+        @param processes set, Set of running ConversionProcess objects
+        """
+        self.processes = processes
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = Configuration()
+
+        self.low_watermark = self.config.getint('memory', 'low_watermark')
+        self.severe_watermark = self.config.getint('memory',
+                                                   'severe_watermark')
+        self.check_interval = self.config.getfloat('memory', 'check_interval')
+
+        self.shed_processes = []
+
+        self.looping_call = tx_task.LoopingCall(self.check)
+
+    def start(self):
+        """
+        Start watching of memory.
+        """
+        if not self.looping_call.running:
+            self.looping_call.start(self.check_interval)
+
+    def stop(self):
+        """
+        Stop watching of memory and resume suspended processes.
+        """
+        if self.looping_call.running:
+            self.looping_call.stop()
+
+        while self.shed_processes:
+            process = self.shed_processes.pop()
+            process.release(self.hold_reason)
+
+    def admit(self, task):
+        """
+        @param task Task
+        @return bool, True if there is enough of available memory or no
+            process is running
+        """
+        if not self.processes:
+            return True
+
+        if self.shed_processes:
+            return False
+
+        available = self.get_available_memory()
+        if available < self.low_watermark:
+            self.logger.debug('Not admitting %s: available memory %d MB is '
+                              'below low watermark %d MB', task, available,
+                              self.low_watermark)
+            return False
+
+        return True
+
+    def task_started(self, task):
+        pass
+
+    def task_finished(self, task):
+        if task.process in self.shed_processes:
+            self.shed_processes.remove(task.process)
+
+    def check(self):
+        """
+        Suspend process under severe memory pressure or resume suspended one
+        when pressure is gone.
+        """
+        available = self.get_available_memory()
+
+        if available < self.severe_watermark:
+            self.shed(available)
+        elif available >= self.low_watermark and self.shed_processes:
+            process = self.shed_processes.pop()
+            self.logger.info('Resuming %s: available memory %d MB', process,
+                             available)
+            process.release(self.hold_reason)
+
+    def shed(self, available):
+        """
+        Suspend the most recently started process which is not suspended,
+        preempted or paused yet.
+        @param available int, Available memory in MB
+        """
+        candidates = [process for process in self.processes
+                      if process.started and not process.finished
+                      and not process.holds and not process.paused]
+        if not candidates:
+            self.logger.warning('Available memory %d MB is below severe '
+                                'watermark %d MB, nothing to suspend',
+                                available, self.severe_watermark)
+            return
+
+        process = max(candidates, key=lambda process: process.start_time)
+
+        self.logger.warning('Suspending %s of %s: available memory %d MB is '
+                            'below severe watermark %d MB, processes use '
+                            '%d MB', process, process.input_file, available,
+                            self.severe_watermark, self.get_processes_rss())
+
+        process.hold(self.hold_reason)
+        self.shed_processes.append(process)
+
+    def get_available_memory(self):
+        """
+        @return int, Available system memory in MB
+        """
+        import psutil
+        return psutil.virtual_memory().available // (1024 * 1024)
+
+    def get_processes_rss(self):
+        """
+        @return int, Resident memory of all processes and their children in MB
+        """
+        import psutil
+
+        rss = 0
+        for process in self.processes:
+            for p in process.get_process_tree():
+                try:
+                    rss += p.get_memory_info().rss
+                except psutil.NoSuchProcess:
+                    pass
+
+        return rss // (1024 * 1024)
@@ -0,0 +1,339 @@
+# -*- coding: utf8 -*-
+"""
+Provides class used to warm up input files of upcoming tasks.
+"""
+
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import sys
+import time
+
+from twisted.internet import defer
+
+from config import Configuration
+from priority import set_thread_io_priority, IOPRIO_IDLE
+from utils import async_function
+
+
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+
+
+def fadvise(file_path, advice):
+    """
+    Call posix_fadvise for whole file. Supported only on Linux.
+    @param file_path str
+    @param advice int, POSIX_FADV_WILLNEED or POSIX_FADV_DONTNEED
+    """
+    import ctypes
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    try:
+        posix_fadvise = libc.posix_fadvise64
+    except AttributeError:
+        posix_fadvise = libc.posix_fadvise
+    posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                              ctypes.c_int]
+
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        errno_ = posix_fadvise(fd, 0, 0, advice)
+        if errno_ != 0:
+            raise OSError(errno_, os.strerror(errno_), file_path)
+    finally:
+        os.close(fd)
+
+
+class CacheEntry(object):
+    """
+    Simple structure that keeps information about prefetched file.
+    """
+    file_path = None
+    cache_path = None
+    size = 0
+    complete = False
+    cancelled = False
+    in_use = False
+    last_used = 0
+
+    def __str__(self):
+        return "<CacheEntry '%s'>" % self.file_path
+
+
+class Prefetcher(object):
+    """
+    Class that warms up input files of next tasks in queue, so processes
+    don't start with cold read path. Supports two modes:
+
+    - fadvise: kernel is asked to read files to page cache
+      (posix_fadvise WILLNEED) at idle I/O priority, advice is revoked
+      (DONTNEED) when file leaves upcoming tasks and is not read by process,
+    - copy: files are copied to local cache directory at idle I/O priority
+      and processes read the copies. Least recently used copies are evicted
+      when byte budget would be exceeded. Unfinished copy of file that leaves
+      upcoming tasks is cancelled.
+
+    Files are warmed one by one and only while sum of their sizes fits to
+    byte budget.
+    """
+    modes = ('none', 'fadvise', 'copy')
+    chunk_size = 1024 * 1024
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = Configuration()
+
+        self.mode = self.config.get('prefetch', 'mode')
+        if self.mode not in self.modes:
+            self.logger.warning('Unknown prefetch mode %s, using none',
+                                self.mode)
+            self.mode = 'none'
+        if self.mode == 'fadvise' and not sys.platform.startswith('linux'):
+            self.logger.warning('Prefetch mode fadvise is supported only on '
+                                'Linux, using none')
+            self.mode = 'none'
+
+        self.tasks_count = self.config.getint('prefetch', 'tasks_count')
+        cache_size = self.config.getint('prefetch', 'cache_size')
+        self.budget = cache_size * 1024 * 1024
+        self.cache_dir = self.config.get('prefetch', 'cache_dir')
+
+        self.entries = {}
+        self.upcoming = []
+        self.lock = defer.DeferredLock()
+
+        self.logger.debug('Prefetch mode: %s', self.mode)
+
+    @property
+    def enabled(self):
+        return self.mode != 'none'
+
+    def update(self, file_paths):
+        """
+        Set input files of upcoming tasks in queue order. Files that are not
+        upcoming anymore are cancelled, new ones are warmed up.
+        @param file_paths list
+        """
+        if not self.enabled:
+            return
+
+        upcoming = file_paths[:self.tasks_count]
+        if upcoming == self.upcoming:
+            return
+
+        self.upcoming = upcoming
+
+        for entry in self.entries.values():
+            if entry.file_path in upcoming or entry.in_use:
+                continue
+
+            # finished copies are kept until they are evicted by budget
+            if not entry.complete or self.mode == 'fadvise':
+                self.cancel(entry)
+
+        for file_path in upcoming:
+            if file_path not in self.entries:
+                self.prefetch(file_path)
+
+    def prefetch(self, file_path):
+        """
+        Warm up file in background.
+        @param file_path str
+        """
+        entry = CacheEntry()
+        entry.file_path = file_path
+        self.entries[file_path] = entry
+
+        d = self.lock.run(self._prefetch, entry)
+        d.addErrback(self._prefetch_failed, entry)
+
+    @defer.inlineCallbacks
+    def _prefetch(self, entry):
+        if entry.cancelled:
+            return
+
+        entry.size = yield self.get_file_size(entry.file_path)
+
+        if not self.make_room(entry):
+            self.logger.debug('No room in prefetch budget for %s', entry)
+            self.entries.pop(entry.file_path, None)
+            return
+
+        self.logger.debug('Prefetching %s (%s)', entry, self.mode)
+
+        if self.mode == 'fadvise':
+            yield self.advise(entry.file_path, POSIX_FADV_WILLNEED)
+        else:
+            entry.cache_path = self.get_cache_path(entry.file_path)
+            yield self.copy(entry)
+
+        if entry.cancelled:
+            # cancelled after file was warmed, entry isn't in cache anymore
+            if self.mode == 'fadvise':
+                yield self.advise(entry.file_path, POSIX_FADV_DONTNEED)
+            else:
+                yield self.remove_file(entry.cache_path)
+            return
+
+        entry.complete = True
+        entry.last_used = time.time()
+
+    def _prefetch_failed(self, fail, entry):
+        self.logger.warning('Prefetching of %s failed: %s', entry,
+                            fail.getErrorMessage())
+        self.entries.pop(entry.file_path, None)
+
+    def make_room(self, entry):
+        """
+        Evict least recently used entries until entry fits to budget.
+        @param entry CacheEntry
+        @return bool, True if entry fits to budget
+        """
+        def used_bytes():
+            return sum(entry_.size for entry_ in self.entries.values()
+                       if entry_.complete)
+
+        candidates = [entry_ for entry_ in self.entries.values()
+                      if entry_.complete and not entry_.in_use
+                      and entry_.file_path not in self.upcoming]
+        candidates.sort(key=lambda entry_: entry_.last_used)
+
+        while used_bytes() + entry.size > self.budget and candidates:
+            self.evict(candidates.pop(0))
+
+        return used_bytes() + entry.size <= self.budget
+
+    def cancel(self, entry):
+        """
+        Cancel prefetching of file. Already warmed file is evicted.
+        @param entry CacheEntry
+        """
+        self.logger.debug('Cancelling prefetch of %s', entry)
+        entry.cancelled = True
+
+        if entry.complete:
+            self.evict(entry)
+        else:
+            self.entries.pop(entry.file_path, None)
+
+    def evict(self, entry):
+        """
+        Remove file from cache or revoke its advice.
+        @param entry CacheEntry
+        """
+        self.logger.debug('Evicting %s', entry)
+        self.entries.pop(entry.file_path, None)
+        entry.complete = False
+
+        if self.mode == 'fadvise':
+            d = self.advise(entry.file_path, POSIX_FADV_DONTNEED)
+        else:
+            d = self.remove_file(entry.cache_path)
+        d.addErrback(lambda fail: self.logger.debug('Eviction failed: %s',
+                                                    fail.getErrorMessage()))
+
+    def acquire(self, file_path):
+        """
+        Return path of file that process should read and mark file as used.
+        When file is not copied to cache, return original path.
+        @param file_path str
+        @return str
+        """
+        entry = self.entries.get(file_path)
+
+        if entry is None:
+            return file_path
+
+        entry.in_use = True
+        entry.last_used = time.time()
+
+        if self.mode != 'copy' or not entry.complete:
+            return file_path
+
+        return entry.cache_path
+
+    def release(self, file_path):
+        """
+        Mark file as not used.
+        @param file_path str
+        """
+        entry = self.entries.get(file_path)
+        if entry is not None:
+            entry.in_use = False
+            entry.last_used = time.time()
+
+    def stop(self):
+        """
+        Cancel all prefetches and clear cache.
+        """
+        self.upcoming = []
+        for entry in self.entries.values():
+            if not entry.in_use:
+                self.cancel(entry)
+
+    def get_cache_path(self, file_path):
+        """
+        @param file_path str
+        @return str, Path of copy in cache directory
+        """
+        digest = hashlib.md5(file_path).hexdigest()[:12]
+        file_name = '%s_%s' % (digest, os.path.basename(file_path))
+        return os.path.join(self.cache_dir, file_name)
+
+    @async_function
+    def get_file_size(self, file_path):
+        return os.stat(file_path).st_size
+
+    @async_function
+    def advise(self, file_path, advice):
+        """
+        Give advice about file at idle I/O priority, so read-ahead doesn't
+        slow down running processes.
+        @param file_path str
+        @param advice int
+        """
+        previous_priority = set_thread_io_priority(IOPRIO_IDLE)
+        try:
+            fadvise(file_path, advice)
+        finally:
+            set_thread_io_priority(previous_priority)
+
+    @async_function
+    def remove_file(self, file_path):
+        if file_path and os.path.exists(file_path):
+            os.remove(file_path)
+
+    @async_function
+    def copy(self, entry):
+        """
+        Copy file to cache at idle I/O priority. Copying is stopped when entry
+        is cancelled.
+        @param entry CacheEntry
+        """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        previous_priority = set_thread_io_priority(IOPRIO_IDLE)
+        try:
+            with open(entry.file_path, 'rb') as src:
+                with open(entry.cache_path, 'wb') as dst:
+                    while not entry.cancelled:
+                        data = src.read(self.chunk_size)
+                        if not data:
+                            break
+                        dst.write(data)
+
+            if entry.cancelled:
+                os.remove(entry.cache_path)
+            else:
+                shutil.copystat(entry.file_path, entry.cache_path)
+        except:
+            if os.path.exists(entry.cache_path):
+                os.remove(entry.cache_path)
+            raise
+        finally:
+            set_thread_io_priority(previous_priority)
@@ -0,0 +1,227 @@
+# -*- coding: utf8 -*-
+"""
+Provides class used to set OS-level priority of spawned processes.
+"""
+
+import logging
+import os
+import os.path
+import sys
+from distutils.spawn import find_executable
+
+from config import Configuration
+
+
+# I/O priority values of ioprio_set(2): class << 13 | level
+IOPRIO_IDLE = 3 << 13
+
+# syscall numbers of ioprio_set and ioprio_get on Linux
+_ioprio_syscalls = {'x86_64': (251, 252),
+                    'i386': (289, 290),
+                    'i686': (289, 290),
+                    'aarch64': (30, 31),
+                    'armv7l': (314, 315)}
+
+
+def set_thread_io_priority(priority):
+    """
+    Set I/O priority of calling thread. Supported only on Linux, elsewhere
+    nothing is done.
+    @param priority int or None, Value of ioprio_set(2), None does nothing
+    @return int or None, Previous priority or None when not supported
+    """
+    import ctypes
+    import platform
+
+    if priority is None or not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        set_nr, get_nr = _ioprio_syscalls[platform.machine()]
+    except KeyError:
+        return None
+
+    IOPRIO_WHO_PROCESS = 1  # with id 0 it's calling thread
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    previous = libc.syscall(get_nr, IOPRIO_WHO_PROCESS, 0)
+    if previous < 0 or libc.syscall(set_nr, IOPRIO_WHO_PROCESS, 0,
+                                    priority) < 0:
+        return None
+
+    return previous
+
+
+class ProcessPriority(object):
+    """
+    Class that applies priority settings from application's configuration
+    file to processes: CPU nice level, I/O scheduling class and optionally
+    cgroup (v2) with CPU and memory limits shared by all processes.
+
+    Settings are read from given section of configuration file, i.e. from
+    the conversion profile. On POSIX platforms command of process is wrapped
+    by shell joining the cgroup and by nice and ionice programs, so settings
+    are applied in child before encoder is executed and are inherited by its
+    children. On win32 nice level is applied after spawn. Failures are logged
+    and ignored, process keeps running with default priority.
+    """
+    ionice_classes = ('none', 'idle', 'best-effort')
+
+    # cgroups which were already prepared
+    _prepared_cgroups = set()
+
+    def __init__(self, section='command'):
+        """
+        Read settings from section of configuration file.
+        @param section str, Section with priority settings
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = Configuration()
+
+        self.nice = self.config.getint(section, 'nice')
+
+        self.ionice_class = self.config.get(section, 'ionice_class')
+        if self.ionice_class not in self.ionice_classes:
+            self.logger.warning('Unknown I/O class %s, using none',
+                                self.ionice_class)
+            self.ionice_class = 'none'
+        self.ionice_level = self.config.getint(section, 'ionice_level')
+
+        self.cgroup = self.config.get(section, 'cgroup')
+        self.cgroup_cpu_max = self.config.get(section, 'cgroup_cpu_max')
+        self.cgroup_memory_max = self.config.get(section, 'cgroup_memory_max')
+
+    def wrap_command(self, args):
+        """
+        Prefix command by programs applying priority settings in child
+        process. Command is not changed on win32.
+        @param args list, Command arguments
+        @return list, Wrapped command arguments
+        """
+        if sys.platform == 'win32':
+            return args
+
+        prefix = []
+
+        if self.cgroup:
+            procs_path = self.get_cgroup_procs_path()
+            if procs_path is not None:
+                # shell moves itself to cgroup and executes rest of command
+                prefix += ['/bin/sh', '-c', 'echo $$ > "$0"; exec "$@"',
+                           procs_path]
+
+        if self.nice != 0:
+            nice_exe = self.find_program('nice')
+            if nice_exe is not None:
+                prefix += [nice_exe, '-n', str(self.nice)]
+
+        if (self.ionice_class != 'none'
+                and sys.platform.startswith('linux')):
+            ionice_exe = self.find_program('ionice')
+            if ionice_exe is not None and self.ionice_class == 'idle':
+                prefix += [ionice_exe, '-c', '3']
+            elif ionice_exe is not None:
+                prefix += [ionice_exe, '-c', '2', '-n',
+                           str(self.ionice_level)]
+
+        return prefix + args
+
+    def find_program(self, name):
+        """
+        @param name str, Name of program
+        @return str or None, Path to program or None when it isn't found
+        """
+        path = find_executable(name)
+        if path is None:
+            self.logger.warning('Program %s not found, priority setting '
+                                'is not applied', name)
+        return path
+
+    def apply(self, pid):
+        """
+        Apply nice level to spawned process on win32, where command is not
+        wrapped.
+        @param pid int, PID of process
+        """
+        import psutil
+
+        if sys.platform != 'win32':
+            return
+
+        try:
+            p = psutil.Process(pid)
+        except psutil.NoSuchProcess:
+            return
+
+        self.set_nice(p)
+
+    def set_nice(self, p):
+        """
+        Set priority class of process mapped from nice level.
+        @param p psutil.Process
+        """
+        import psutil
+
+        if self.nice == 0:
+            return
+
+        if self.nice >= 15:
+            value = psutil.IDLE_PRIORITY_CLASS
+        elif self.nice > 0:
+            value = psutil.BELOW_NORMAL_PRIORITY_CLASS
+        else:
+            value = psutil.ABOVE_NORMAL_PRIORITY_CLASS
+
+        try:
+            p.set_nice(value)
+        except (psutil.Error, OSError) as e:
+            self.logger.warning('Cannot set nice of %s: %s', p.pid, e)
+
+    def get_cgroup_procs_path(self):
+        """
+        Return path to file listing processes of cgroup. Cgroup is created
+        and its limits are set when used first time.
+        @return str or None, Path or None when cgroup can't be used
+        """
+        try:
+            if self.cgroup not in self._prepared_cgroups:
+                self.prepare_cgroup()
+                self._prepared_cgroups.add(self.cgroup)
+        except (IOError, OSError) as e:
+            self.logger.warning('Cannot prepare cgroup %s: %s', self.cgroup,
+                                e)
+            return None
+
+        return os.path.join(self.cgroup, 'cgroup.procs')
+
+    def prepare_cgroup(self):
+        """
+        Create cgroup, enable its controllers in parent and set limits.
+        """
+        self.logger.info('Preparing cgroup %s (cpu.max=%s, memory.max=%s)',
+                         self.cgroup, self.cgroup_cpu_max,
+                         self.cgroup_memory_max)
+
+        if not os.path.exists(self.cgroup):
+            os.mkdir(self.cgroup)
+
+        parent_control = os.path.join(os.path.dirname(self.cgroup),
+                                      'cgroup.subtree_control')
+        for controller, limit in (('cpu', self.cgroup_cpu_max),
+                                  ('memory', self.cgroup_memory_max)):
+            if not limit:
+                continue
+
+            try:
+                with open(parent_control, 'w') as f:
+                    f.write('+' + controller)
+            except (IOError, OSError) as e:
+                self.logger.debug('Cannot enable controller %s: %s',
+                                  controller, e)
+
+            self._write_cgroup_file(controller + '.max', limit)
+
+    def _write_cgroup_file(self, file_name, value):
+        with open(os.path.join(self.cgroup, file_name), 'w') as f:
+            f.write(value)
@@ -0,0 +1,266 @@
+# -*- coding: utf8 -*-
+"""
+Provides classes used to find out information about media files.
+"""
+
+import logging
+import os
+import re
+import shlex
+import sys
+
+from twisted.internet import defer
+
+from backend import get_backend
+from config import Configuration
+from utils import (singleton, async_function, encode, spawn_process,
+                   CollectingProcessProtocol)
+
+
+class MediaInfo(object):
+    """
+    Simple structure that keeps information about media file. Attributes
+    which could not be found out are None.
+    """
+    file_path = None
+    file_size = None
+    probed = False
+    demuxer = None
+    duration = None
+    width = None
+    height = None
+    aspect = None
+    fps = None
+    video_format = None
+    video_bitrate = None
+    audio_format = None
+    audio_bitrate = None
+    # progressive, interlaced or telecine
+    scan_type = None
+
+    def __str__(self):
+        return ("<MediaInfo '%s' duration=%s size=%sx%s fps=%s scan=%s>"
+                % (self.file_path, self.duration, self.width, self.height,
+                   self.fps, self.scan_type))
+
+
+@singleton
+class MediaProber(object):
+    """
+    Singleton class that probes media files by probe program of encoder
+    backend selected in application's configuration file. Results are
+    cached by file path, so each file is probed only once. Count of
+    concurrently running probes is limited by configuration.
+
+    Scan type of video (progressive, interlaced or telecine) is detected by
+    optional analysis of frames by idet filter of ffmpeg. When analysis is
+    not configured or gives no result, scan type is guessed from frame rate:
+    NTSC rates (29.97 and 59.94 fps) are supposed to be telecined film, other
+    known rates progressive.
+    """
+    # summary lines of idet filter, e.g.
+    # Multi frame detection: TFF: 12 BFF: 0 Progressive: 580 Undetermined: 8
+    # Repeated Fields: Neither: 360 Top: 120 Bottom: 120
+    idet_frames_re = re.compile(r'Multi frame detection:\s*TFF:\s*(\d+)\s*'
+                                r'BFF:\s*(\d+)\s*Progressive:\s*(\d+)')
+    idet_fields_re = re.compile(r'Repeated Fields:\s*Neither:\s*(\d+)\s*'
+                                r'Top:\s*(\d+)\s*Bottom:\s*(\d+)')
+    # part of frames with repeated field that means 3:2 pulldown
+    telecine_ratio = 0.2
+    ntsc_rates = (30000.0 / 1001, 60000.0 / 1001)
+
+    def __init__(self):
+        self.config = Configuration()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.backend = get_backend()
+
+        self.cache = {}
+        self.pending = {}
+
+        processes_count = self.config.getint('probe', 'processes_count')
+        self.semaphore = defer.DeferredSemaphore(processes_count)
+
+    def get_cached_info(self, file_path):
+        """
+        Return already known information about file or None.
+        @param file_path str
+        @return MediaInfo or None
+        """
+        return self.cache.get(file_path)
+
+    def probe(self, file_path):
+        """
+        Find out information about file. Failure of probe is not propagated,
+        returned MediaInfo has attribute probed set to False.
+        @param file_path str
+        @return t.i.d.Deferred, MediaInfo
+        """
+        if file_path in self.cache:
+            return defer.succeed(self.cache[file_path])
+
+        d = defer.Deferred()
+
+        if file_path in self.pending:
+            self.pending[file_path].append(d)
+            return d
+
+        self.pending[file_path] = [d]
+
+        def probe_finished(info):
+            self.cache[file_path] = info
+            for waiting in self.pending.pop(file_path):
+                waiting.callback(info)
+
+        probe_d = self.semaphore.run(self._probe, file_path)
+        probe_d.addCallback(probe_finished)
+
+        return d
+
+    @defer.inlineCallbacks
+    def _probe(self, file_path):
+        """
+        Run probe process and parse its output.
+        @param file_path str
+        @return t.i.d.Deferred, MediaInfo
+        """
+        info = MediaInfo()
+        info.file_path = file_path
+
+        try:
+            info.file_size = yield self.get_file_size(file_path)
+
+            self.logger.debug('Probing file: %s', file_path)
+
+            output = yield self.run_probe_command(file_path)
+            if not self.backend.parse_probe_output(output, info):
+                raise ValueError('no information found')
+            info.probed = True
+
+            info.scan_type = yield self.detect_scan_type(file_path, info)
+        except Exception as e:
+            self.logger.warning('Probe of %s failed: %s', file_path, e)
+
+        self.logger.debug('Probed: %s', info)
+
+        defer.returnValue(info)
+
+    @async_function
+    def get_file_size(self, file_path):
+        """
+        @param file_path str
+        @return t.i.d.Deferred, int
+        """
+        return os.stat(file_path).st_size
+
+    def run_probe_command(self, file_path):
+        """
+        Run probe command and return its stdout.
+        @param file_path str
+        @return t.i.d.Deferred, str
+        """
+        args = self.backend.get_probe_command(file_path)
+
+        d = defer.Deferred()
+        proto = CollectingProcessProtocol(d)
+        spawn_process(proto, args)
+
+        d.addErrback(lambda _: proto.stdout)
+
+        return d
+
+    @defer.inlineCallbacks
+    def detect_scan_type(self, file_path, info):
+        """
+        Detect scan type of video by analysis or guess it from frame rate.
+        @param file_path str
+        @param info MediaInfo, Probed information about file
+        @return t.i.d.Deferred, str or None
+        """
+        scan_type = None
+
+        args = self.get_analyze_command(file_path)
+        if args is not None:
+            self.logger.debug('Analyzing file: %s', file_path)
+            d = defer.Deferred()
+            proto = CollectingProcessProtocol(d)
+            spawn_process(proto, args)
+            try:
+                yield d
+            except Exception:
+                pass  # exit status is not important, output is parsed
+
+            scan_type = self.parse_idet_output(proto.stderr)
+            if scan_type is None:
+                self.logger.debug('Analysis of %s gave no result', file_path)
+
+        if scan_type is None:
+            scan_type = self.guess_scan_type(info)
+
+        defer.returnValue(scan_type)
+
+    def parse_idet_output(self, output):
+        """
+        Parse summary of idet filter. The last summary is used.
+        @param output str, Output of analysis command
+        @return str or None, Scan type or None when output has no summary
+        """
+        frames = self.idet_frames_re.findall(output)
+        if not frames:
+            return None
+
+        tff, bff, progressive = [int(value) for value in frames[-1]]
+        total = tff + bff + progressive
+        if total == 0:
+            return None
+
+        fields = self.idet_fields_re.findall(output)
+        if fields:
+            neither, top, bottom = [int(value) for value in fields[-1]]
+            repeated_total = neither + top + bottom
+            if (repeated_total > 0 and float(top + bottom) / repeated_total
+                    >= self.telecine_ratio):
+                return 'telecine'
+
+        if tff + bff > progressive:
+            return 'interlaced'
+
+        return 'progressive'
+
+    def guess_scan_type(self, info):
+        """
+        Guess scan type of video from its frame rate.
+        @param info MediaInfo
+        @return str or None, Scan type or None when frame rate is unknown
+        """
+        if not info.fps:
+            return None
+
+        for rate in self.ntsc_rates:
+            if abs(info.fps - rate) < 0.01:
+                return 'telecine'
+
+        return 'progressive'
+
+    def get_analyze_command(self, file_path):
+        """
+        Make command of analysis from patterns in application's config file.
+        @param file_path str
+        @return list or None, Command arguments or None when analysis is not
+            configured
+        """
+        if sys.platform in ('win32', 'cygwin'):
+            analyze_exe = self.config.get('probe', 'analyze_exe_win')
+        else:
+            analyze_exe = self.config.get('probe', 'analyze_exe_unix')
+
+        if not analyze_exe:
+            return None
+
+        input_file_alias = self.config.get('command', 'input_file_alias')
+        analyze_args = self.config.get('probe', 'analyze_args')
+        analyze_args = analyze_args.replace(input_file_alias, file_path)
+
+        analyze_command = '"' + analyze_exe + '" ' + analyze_args
+
+        return shlex.split(encode(analyze_command))
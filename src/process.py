@@ -4,14 +4,21 @@ Provides class implementing conversion process.
 """
 
 import logging
+import os
 import shlex
 import sys
 import tempfile
+import time
 
-from twisted.internet import defer, error, reactor
+from twisted.internet import defer, error, task as tx_task
 
+from backend import get_backend
 from config import Configuration
-from utils import WatchingProcessProtocol, async_function, encode, decode
+from priority import ProcessPriority
+from profiling import timed
+from scaling import VideoScaling
+from utils import (WatchingProcessProtocol, async_function, encode, decode,
+                   spawn_process)
 
 
 class ConversionProcess():
@@ -21,12 +28,33 @@ class ConversionProcess():
     log its returncode and stderr and stdout.
 
     State of process coluld be checked by this properties: started, finished,
-    paused, cancelled, pid. When process is finished its status is in additional
+    paused, cancelled, aborted, pid. When process is finished its status is in additional
     properties: returncode, stderr, stdout.
 
-    Process support this operations: run, terminate, pause, resume.
+    Progress of running process is parsed from its output by encoder backend
+    selected in configuration and stored in properties: position, frames,
+    percent, fps.
+
+    Process support this operations: run, terminate, abort, pause, resume.
+    Process could be also suspended by other parties (e.g. throttling) by hold
+    and release operations. Time of last activity and time spent by running
+    (without suspensions) are tracked for watchdog.
+
+    When direct output is enabled (not supported on Windows), stdout and
+    stderr of process are connected directly to log files, so output doesn't
+    pass through reactor. Progress is then polled from tail of stdout log.
     """
-    def __init__(self, input_file, sub_file, output_file, log_stdout=False):
+    # section of configuration file with OS-level priority of process
+    priority_section = 'command'
+
+    # options with video filters for scan types of input, unknown scan type
+    # is converted as telecine
+    video_filters_options = {'progressive': 'progressive_filters',
+                             'interlaced': 'interlace_filters',
+                             'telecine': 'telecine_filters'}
+
+    def __init__(self, input_file, sub_file, output_file, log_stdout=False,
+                 media_info=None, threads=1):
         """
         Store information about input and output files and subtitles. Store if
         log stdout and set object's attributes.
@@ -34,22 +62,47 @@ class ConversionProcess():
         @param sub_file str, Path to subtitles file
         @param output_file str, Path to output file
         @param log_stdout bool, Store stdout after process finish
+        @param media_info MediaInfo, Probed information about input file
+        @param threads int, Count of threads of encoder
         """
         self.input_file = input_file
         self.sub_file = sub_file
         self.output_file = output_file
         self.log_stdout = log_stdout
+        self.media_info = media_info
+        self.threads = threads
+        # size of scaled output video and its bitrate
+        self.output_size = None
+        self.video_bitrate = None
+        # streams which are copied without conversion
+        self.video_copy = False
+        self.audio_copy = False
+        # additional arguments put in front of arguments from configuration
+        self.extra_args = None
 
         self.config = Configuration()
         self.logger = logging.getLogger(self.__class__.__name__)
 
+        self.backend = get_backend()
+
+        self.direct_output = (self.config.getboolean('command', 'direct_output')
+                              and sys.platform != 'win32')
+        self.progress_interval = self.config.getfloat('command',
+                                                      'progress_interval')
+        self.progress_tail_size = 4096
+        self.progress_poller = None
+        self._polled_sizes = (0, 0)
+
         self.process_transport = None
         self.process_protocol = None
+        self._psutil_process = None
 
         self.started = False
         self.finished = False
         self.paused = False
         self.cancelled = False
+        self.aborted = False
+        self.holds = set()
         self.deferred = defer.Deferred()
         self.deferred.addErrback(self.process_exited)
 
@@ -58,6 +111,18 @@ class ConversionProcess():
         self.stderr = None
         self.stdout = None
 
+        self.start_time = None
+        self.end_time = None
+        self.last_activity = None
+        self.first_output_time = None
+        self.held_time = 0.0
+        self._hold_start = None
+        self.position = None
+        self.frames = None
+        self.percent = None
+        self.fps = None
+        self._progress_buffer = ''
+
     def run(self):
         """
         Star conversion process.
@@ -69,29 +134,55 @@ class ConversionProcess():
         conversion_command = encode(conversion_command)
 
         args = shlex.split(conversion_command)
-        executable = args[0]
 
-        self.open_stdout_log()
-        self.open_stderr_log()
+        priority = ProcessPriority(self.priority_section)
+        args = priority.wrap_command(args)
 
         proto = WatchingProcessProtocol(self.deferred)
 
-        proto.outReceived = lambda data: self.stdout_log.write(data)
-        proto.errReceived = lambda data: self.stderr_log.write(data)
-
         self.logger.info('Starting conversion process of %s', self.input_file)
 
-        kwargs = {}
+        if self.direct_output:
+            stdout_fd = self.open_direct_stdout_log()
+            stderr_fd = self.open_direct_stderr_log()
+            try:
+                child_fds = {0: 'w', 1: stdout_fd, 2: stderr_fd}
+                self.process_transport = spawn_process(proto, args,
+                                                       childFDs=child_fds)
+            finally:
+                # process has its own copies of descriptors
+                os.close(stdout_fd)
+                os.close(stderr_fd)
+
+            self.progress_poller = tx_task.LoopingCall(self.poll_progress)
+            self.progress_poller.start(self.progress_interval, now=False)
+        else:
+            self.open_stdout_log()
+            self.open_stderr_log()
 
-        if sys.platform == 'win32':
-            import win32process
-            kwargs['win32flags'] = win32process.CREATE_NO_WINDOW
+            def out_received(data):
+                self.stdout_log.write(data)
+                self.update_progress(data)
 
-        self.process_transport = reactor.spawnProcess(proto, executable, args, **kwargs)
+            def err_received(data):
+                self.stderr_log.write(data)
+                if self.first_output_time is None:
+                    self.first_output_time = time.time()
+                if self.frames is None:
+                    self.last_activity = time.time()
+
+            proto.outReceived = out_received
+            proto.errReceived = err_received
+
+            self.process_transport = spawn_process(proto, args)
 
         self.process_protocol = proto
         self.pid = self.process_transport.pid
         self.started = True
+        self.start_time = time.time()
+        self.last_activity = self.start_time
+
+        priority.apply(self.pid)
 
         return self.deferred
 
@@ -105,6 +196,11 @@ class ConversionProcess():
 
         self.logger.info('Terminating conversion process of %s', self.input_file)
 
+        if self.holds:
+            # suspended process would not handle the signal
+            self.holds.clear()
+            self.resume_tree()
+
         try:
             self.process_transport.signalProcess('TERM')
         except error.ProcessExitedAlready:
@@ -112,6 +208,55 @@ class ConversionProcess():
 
         self.deferred.cancel()
 
+    def abort(self, kill_delay):
+        """
+        Abort hanging process. Send TERM to process and when it doesn't exit
+        until delay expires, kill process and all its children. Unlike
+        terminate deferred is not cancelled, so it's callbacked when process
+        exits.
+        @param kill_delay float, Delay before kill in seconds
+        """
+        from twisted.internet import reactor
+
+        if self.finished or self.aborted:
+            return
+
+        self.logger.warning('Aborting conversion process of %s',
+                            self.input_file)
+
+        self.aborted = True
+
+        if self.holds:
+            self.holds.clear()
+            self.resume_tree()
+
+        # children are not in own process group, so they are collected now,
+        # before parent exits and they are orphaned
+        process_tree = self.get_process_tree()
+
+        try:
+            self.process_transport.signalProcess('TERM')
+        except error.ProcessExitedAlready:
+            return
+
+        reactor.callLater(kill_delay, self.kill_tree, process_tree)
+
+    def kill_tree(self, process_tree):
+        """
+        Kill processes from tree that are still running.
+        @param process_tree list, List of psutil.Process
+        """
+        import psutil
+
+        for p in process_tree:
+            try:
+                if p.is_running():
+                    self.logger.warning('Killing process %s of %s', p.pid,
+                                        self.input_file)
+                    p.kill()
+            except psutil.NoSuchProcess:
+                pass
+
     def pause(self):
         """
         Pause process running.
@@ -120,12 +265,8 @@ class ConversionProcess():
         assert not self.finished
         assert not self.paused
 
-        p = self._get_psutil_process()
-        if p:
-            p.suspend()
-            self.paused = True
-        else:
-            self.logger.debug('psutil process is None')
+        self.hold('pause')
+        self.paused = True
 
     def resume(self):
         """
@@ -137,11 +278,170 @@ class ConversionProcess():
 
         self.paused = False
 
-        p = self._get_psutil_process()
-        if p:
-            p.resume()
+        self.release('pause')
+
+    def hold(self, reason):
+        """
+        Suspend process tree for given reason. Process tree stays suspended
+        until all reasons are released.
+        @param reason str, E.g. 'pause' or 'throttle'
+        """
+        if self.finished or self.aborted or reason in self.holds:
+            return
+
+        if not self.holds:
+            self.suspend_tree()
+            self._hold_start = time.time()
+
+        self.holds.add(reason)
+
+    def release(self, reason):
+        """
+        Release suspension for given reason. Resume process tree when no other
+        reason is held.
+        @param reason str
+        """
+        if reason not in self.holds:
+            return
+
+        self.holds.remove(reason)
+
+        if not self.holds and not self.finished:
+            self.resume_tree()
+
+            # time of suspension is not counted as idle time
+            held = time.time() - self._hold_start
+            self.held_time += held
+            self.last_activity += held
+
+    def suspend_tree(self):
+        """
+        Suspend process and all its children.
+        """
+        import psutil
+        for p in self.get_process_tree():
+            try:
+                p.suspend()
+            except psutil.NoSuchProcess:
+                pass
+
+    def resume_tree(self):
+        """
+        Resume process and all its children.
+        """
+        import psutil
+        for p in self.get_process_tree():
+            try:
+                p.resume()
+            except psutil.NoSuchProcess:
+                pass
+
+    def set_cpu_affinity(self, cpus):
+        """
+        Pin process and all its children to CPUs.
+        @param cpus list, List of CPU numbers
+        """
+        import psutil
+        for p in self.get_process_tree():
+            try:
+                p.set_cpu_affinity(cpus)
+            except (psutil.Error, OSError) as e:
+                self.logger.warning('Cannot set CPU affinity of %s: %s',
+                                    p.pid, e)
+
+    def update_progress(self, data):
+        """
+        Parse progress from report in output of process.
+        @param data str, Chunk of output
+        """
+        if self.first_output_time is None:
+            self.first_output_time = time.time()
+
+        # report of ffmpeg spans several lines
+        self._progress_buffer = (self._progress_buffer + data)[-1024:]
+
+        duration = None
+        if self.media_info is not None:
+            duration = self.media_info.duration
+
+        progress = self.backend.parse_progress(self._progress_buffer, duration)
+
+        if progress is None:
+            if self.frames is None:
+                self.last_activity = time.time()
+            return
+
+        if progress['frames'] != self.frames:
+            self.last_activity = time.time()
+
+        self.position = progress['position']
+        self.frames = progress['frames']
+        self.percent = progress['percent']
+        self.fps = progress['fps']
+
+    def poll_progress(self):
+        """
+        Parse progress from tail of stdout log when output of process is
+        written directly to log files. Change of size of stderr log is
+        counted as activity when progress is not known.
+        """
+        sizes = (os.fstat(self.stdout_log.fileno()).st_size,
+                 os.fstat(self.stderr_log.fileno()).st_size)
+        if sizes == self._polled_sizes:
+            return
+
+        stdout_changed = sizes[0] != self._polled_sizes[0]
+        self._polled_sizes = sizes
+
+        if stdout_changed:
+            self.stdout_log.seek(max(0, sizes[0] - self.progress_tail_size))
+            self._progress_buffer = ''
+            self.update_progress(self.stdout_log.read(self.progress_tail_size))
         else:
+            if self.first_output_time is None:
+                self.first_output_time = time.time()
+            if self.frames is None:
+                self.last_activity = time.time()
+
+    def get_idle_time(self):
+        """
+        Return time since last activity of process, i.e. since last change
+        of progress or since last output when progress is not known. Periods
+        when process was suspended are not counted.
+        @return float, Time in seconds
+        """
+        return time.time() - self.last_activity
+
+    def get_run_time(self):
+        """
+        Return time spent by running, periods when process was suspended are
+        not counted.
+        @return float, Time in seconds
+        """
+        end_time = self.end_time or time.time()
+        held_time = self.held_time
+        if self.holds:
+            held_time += end_time - self._hold_start
+
+        return end_time - self.start_time - held_time
+
+    def get_process_tree(self):
+        """
+        Return process and all its children. Return empty list if process
+        isn't running.
+        @return list, List of psutil.Process
+        """
+        import psutil
+
+        p = self._get_psutil_process()
+        if p is None:
             self.logger.debug('psutil process is None')
+            return []
+
+        try:
+            return [p] + p.get_children(recursive=True)
+        except psutil.NoSuchProcess:
+            return []
 
     def get_conversion_command(self):
         """
@@ -165,8 +465,43 @@ class ConversionProcess():
         convertor_args = convertor_args.replace(output_file_alias,
                                                 self.output_file)
 
-        convertor_args = self.extend_command_by_sub(self.sub_file,
-                                                    convertor_args)
+        video_filters = self.get_video_filters()
+        sub_params = self.get_sub_params(self.sub_file)
+        # backend could render subtitles by video filter
+        video_filters, sub_params = self.backend.add_subtitles(video_filters,
+                                                               sub_params)
+
+        sub_params_alias = self.config.get('command', 'subtitle_params_alias')
+        convertor_args = convertor_args.replace(sub_params_alias, sub_params)
+
+        video_filters_alias = self.config.get('command', 'video_filters_alias')
+        convertor_args = convertor_args.replace(video_filters_alias,
+                                                video_filters)
+
+        # video could be copied only when it isn't filtered
+        self.video_copy = (not video_filters.strip() and not self.sub_file
+                           and self.is_stream_copyable('video'))
+        self.audio_copy = self.is_stream_copyable('audio')
+
+        for stream, copy in (('video', self.video_copy),
+                             ('audio', self.audio_copy)):
+            params_alias = self.config.get('command', stream + '_params_alias')
+            params_option = stream + ('_copy_params' if copy else '_params')
+            params = self.config.get('command', params_option)
+            convertor_args = convertor_args.replace(params_alias, params)
+
+        self.video_bitrate = VideoScaling().get_video_bitrate(self.media_info)
+        if self.video_bitrate is not None:
+            bitrate_alias = self.config.get('command', 'video_bitrate_alias')
+            convertor_args = convertor_args.replace(bitrate_alias,
+                                                    str(self.video_bitrate))
+
+        threads_alias = self.config.get('command', 'threads_alias')
+        convertor_args = convertor_args.replace(threads_alias,
+                                                str(self.threads))
+
+        if self.extra_args:
+            convertor_args = self.extra_args + ' ' + convertor_args
 
         conversion_command = convertor_exe + ' ' + convertor_args
 
@@ -174,14 +509,69 @@ class ConversionProcess():
 
         return conversion_command
 
-    def extend_command_by_sub(self, sub_file, conversion_command):
+    def get_video_filters(self):
+        """
+        Return video filter options for scan type of input file, so
+        inverse telecine or deinterlacing is used only when needed. Scaling
+        is appended when input is larger than maximum resolution.
+        @return str
         """
-        Expand command's alias for subtitles with params or nothing
-        if subtitles are not requested.
+        scan_type = None
+        if self.media_info is not None:
+            scan_type = self.media_info.scan_type
+
+        option = self.video_filters_options.get(scan_type, 'telecine_filters')
+        video_filters = self.config.get('command', option)
+
+        self.output_size = VideoScaling().get_output_size(self.media_info)
+        if self.output_size is not None:
+            scale_params = self.config.get('command', 'scale_params')
+            scale_params = scale_params.replace('%%scaleWidth%%',
+                                                str(self.output_size[0]))
+            scale_params = scale_params.replace('%%scaleHeight%%',
+                                                str(self.output_size[1]))
+            video_filters = (video_filters + ' ' + scale_params).strip()
+
+        self.logger.debug('Video filters of %s (scan type %s): %s',
+                          self.input_file, scan_type, video_filters)
+
+        return video_filters
+
+    def is_stream_copyable(self, stream):
+        """
+        Check if stream of input file already matches target of conversion,
+        i.e. its format is one of formats which could be copied and its
+        bitrate doesn't exceed limit.
+        @param stream str, video or audio
+        @return bool
+        """
+        info = self.media_info
+        if info is None or not self.backend.stream_copy:
+            return False
+
+        formats = self.config.get('command', stream + '_copy_formats')
+        formats = [format_.strip().lower() for format_ in formats.split(',')
+                   if format_.strip()]
+
+        format_ = getattr(info, stream + '_format')
+        if format_ is None or format_.lower() not in formats:
+            return False
+
+        max_bitrate = self.config.getint('command',
+                                         stream + '_copy_max_bitrate')
+        if max_bitrate > 0:
+            bitrate = getattr(info, stream + '_bitrate')
+            if bitrate is None or bitrate > max_bitrate * 1000:
+                return False
+
+        return True
+
+    def get_sub_params(self, sub_file):
+        """
+        Return params of subtitles or nothing if subtitles are not
+        requested.
         @param sub_file str, Path of subtitles file
-        @param conversion_command str, Command without expanded alias for
-            subtitles
-        @return str, Expanded command
+        @return str
         """
         sub_params = ''
         if sub_file:
@@ -189,10 +579,7 @@ class ConversionProcess():
             sub_params = self.config.get('command', 'subtitle_params')
             sub_params = sub_params.replace(sub_file_alias, sub_file)
 
-        sub_params_alias = self.config.get('command', 'subtitle_params_alias')
-        conversion_command = conversion_command.replace(sub_params_alias,
-                                                        sub_params)
-        return conversion_command
+        return sub_params
 
     def open_stderr_log(self):
         """
@@ -210,6 +597,41 @@ class ConversionProcess():
         self.stdout_log = tempfile.TemporaryFile()
         return self.stdout_log.fileno()
 
+    def open_direct_log(self):
+        """
+        Create temporary file that is written directly by process. File is
+        written through its own descriptor and read through separate file
+        object, so reading doesn't move position of writing.
+        @return tuple, FD of file for process and file object for reading
+        """
+        fd, path = tempfile.mkstemp(prefix='videoconvertor_')
+        try:
+            log_file = open(path, 'rb')
+        except:
+            os.close(fd)
+            raise
+        finally:
+            os.remove(path)
+
+        return fd, log_file
+
+    def open_direct_stderr_log(self):
+        """
+        Open temporary file written directly by process as its stderr.
+        @return int, FD of file for process
+        """
+        fd, self.stderr_log = self.open_direct_log()
+        return fd
+
+    def open_direct_stdout_log(self):
+        """
+        Open temporary file written directly by process as its stdout.
+        @return int, FD of file for process
+        """
+        fd, self.stdout_log = self.open_direct_log()
+        return fd
+
+    @timed('ConversionProcess.process_exited')
     @defer.inlineCallbacks
     def process_exited(self, failure):
         """
@@ -220,6 +642,11 @@ class ConversionProcess():
         @return t.i.d.Deferred
         """
         self.finished = True
+        self.end_time = time.time()
+
+        if self.progress_poller is not None and self.progress_poller.running:
+            self.progress_poller.stop()
+            self.poll_progress()
 
         status_type = failure.trap(error.ProcessDone, error.ProcessTerminated)
 
@@ -235,8 +662,9 @@ class ConversionProcess():
                 else:
                     raise ValueError('Unknown exit status')
 
-            self.logger.info('Conversion process of %s exited with status %s',
-                             self.input_file, self.returncode)
+            self.logger.info('Conversion process of %s exited with status %s '
+                             '(%s frames, %s fps)', self.input_file,
+                             self.returncode, self.frames, self.fps)
 
             self.stderr = yield self.read_from_temp_file(self.stderr_log)
 
@@ -261,5 +689,15 @@ class ConversionProcess():
     def _get_psutil_process(self):
         # psutil provides cross-platform process stop & cont orders
         import psutil
-        p = psutil.Process(self.pid)
-        return (None if p.status in (psutil.STATUS_DEAD, psutil.STATUS_ZOMBIE) else p)
+
+        if self.finished:
+            return None
+
+        try:
+            if self._psutil_process is None:
+                self._psutil_process = psutil.Process(self.pid)
+
+            p = self._psutil_process
+            return (None if p.status in (psutil.STATUS_DEAD, psutil.STATUS_ZOMBIE) else p)
+        except psutil.NoSuchProcess:
+            return None
@@ -0,0 +1,255 @@
+# -*- coding: utf8 -*-
+"""
+Provides instrumentation used to find out why application responds slowly:
+lag of reactor, counters of time spent in hot functions and profiling by
+cProfile toggled at runtime.
+"""
+
+import cProfile
+import functools
+import logging
+import os
+import os.path
+import pstats
+import signal
+import time
+from datetime import datetime
+
+from twisted.internet import task as tx_task
+
+from config import Configuration
+from utils import get_app_dir, singleton
+
+
+@singleton
+class Timings(object):
+    """
+    Counters of calls of instrumented functions: count of calls, total and
+    maximum time. Counting is disabled until Instrumentation is started.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}
+
+    def add(self, name, elapsed):
+        """
+        @param name str, Name of instrumented function
+        @param elapsed float, Duration of call in seconds
+        """
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = self.counters[name] = [0, 0.0, 0.0]
+
+        counter[0] += 1
+        counter[1] += elapsed
+        counter[2] = max(counter[2], elapsed)
+
+    def reset(self):
+        self.counters.clear()
+
+    def format_report(self):
+        """
+        @return str, Table of counters sorted by total time
+        """
+        lines = ['%-50s %8s %10s %10s %10s' % ('function', 'calls', 'total ms',
+                                               'avg ms', 'max ms')]
+        items = sorted(self.counters.iteritems(), key=lambda item: -item[1][1])
+        for name, (count, total, maximum) in items:
+            lines.append('%-50s %8d %10.1f %10.3f %10.3f'
+                         % (name, count, total * 1000, total * 1000 / count,
+                            maximum * 1000))
+        return '\n'.join(lines) + '\n'
+
+
+def timed(name):
+    """
+    Decorator. Count time spent by calls of decorated function. When function
+    returns t.i.d.Deferred, only its synchronous part is measured.
+    @param name str, Name of function in report
+    @return function
+    """
+    def decorator(fnc):
+        @functools.wraps(fnc)
+        def wrapper(*args, **kwargs):
+            timings = Timings()
+            if not timings.enabled:
+                return fnc(*args, **kwargs)
+
+            start = time.time()
+            try:
+                return fnc(*args, **kwargs)
+            finally:
+                timings.add(name, time.time() - start)
+        return wrapper
+    return decorator
+
+
+class LagMonitor(object):
+    """
+    Class that measures how late reactor runs scheduled calls. Call is
+    scheduled periodically, difference between expected and real time of call
+    is lag of reactor. Lag over threshold is logged as warning.
+    """
+    def __init__(self, interval, warning_lag):
+        """
+        @param interval float, Interval of measurement in seconds
+        @param warning_lag float, Lag in seconds that is logged
+        """
+        self.interval = interval
+        self.warning_lag = warning_lag
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.looping_call = tx_task.LoopingCall(self.measure)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.late_count = 0
+        self.last_time = None
+
+    def start(self):
+        if not self.looping_call.running:
+            self.last_time = time.time()
+            self.looping_call.start(self.interval, now=False)
+
+    def stop(self):
+        if self.looping_call.running:
+            self.looping_call.stop()
+
+    def measure(self):
+        now = time.time()
+        lag = max(0.0, now - self.last_time - self.interval)
+        self.last_time = now
+
+        self.count += 1
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+
+        if lag > self.warning_lag:
+            self.late_count += 1
+            self.logger.warning('Reactor lag %.3f s', lag)
+
+    def format_report(self):
+        """
+        @return str
+        """
+        avg_lag = self.total_lag / self.count if self.count else 0.0
+        return ('Reactor lag: %d measurements, avg %.1f ms, max %.1f ms, '
+                '%d over %.0f ms\n' % (self.count, avg_lag * 1000,
+                                       self.max_lag * 1000, self.late_count,
+                                       self.warning_lag * 1000))
+
+
+class Instrumentation(object):
+    """
+    Class that starts lag monitor and counting of timings when enabled in
+    configuration. Profiling of reactor thread by cProfile is toggled by
+    signal SIGUSR1, SIGUSR2 writes report of timings and lag (signals are not
+    available on Windows). Profiles and reports are written to directory
+    profile in application's directory, report is written also when
+    application terminates.
+    """
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = Configuration()
+
+        self.enabled = self.config.getboolean('profiling', 'enabled')
+        self.report_lines = self.config.getint('profiling', 'report_lines')
+
+        self.lag_monitor = LagMonitor(
+            self.config.getfloat('profiling', 'lag_interval'),
+            self.config.getfloat('profiling', 'lag_warning'))
+
+        self.profiler = None
+
+    def start(self):
+        """
+        Start instrumentation when enabled.
+        """
+        from twisted.internet import reactor
+
+        if not self.enabled:
+            return
+
+        self.logger.info('Instrumentation enabled')
+
+        Timings().enabled = True
+        self.lag_monitor.start()
+
+        if hasattr(signal, 'SIGUSR1'):
+            def on_signal(signum, frame):
+                action = (self.toggle_profiler if signum == signal.SIGUSR1
+                          else self.write_report)
+                reactor.callFromThread(action)
+
+            signal.signal(signal.SIGUSR1, on_signal)
+            signal.signal(signal.SIGUSR2, on_signal)
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        """
+        Stop instrumentation and write final report.
+        """
+        if self.profiler is not None:
+            self.toggle_profiler()
+
+        self.lag_monitor.stop()
+        self.write_report()
+        Timings().enabled = False
+
+    def get_report_path(self, prefix, extension):
+        """
+        @param prefix str
+        @param extension str
+        @return str, Path to new file in directory of reports
+        """
+        report_dir_path = os.path.join(get_app_dir(), 'profile')
+        if not os.path.exists(report_dir_path):
+            os.mkdir(report_dir_path)
+
+        file_name = '%s_%s.%s' % (prefix, datetime.now(), extension)
+        # colon is not allowed in windows path
+        file_name = file_name.replace(':', '-')
+
+        return os.path.join(report_dir_path, file_name)
+
+    def toggle_profiler(self):
+        """
+        Start profiling of reactor thread or stop it and write profile (binary
+        for pstats and text with the most expensive functions).
+        """
+        if self.profiler is None:
+            self.logger.info('Starting profiler')
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            return
+
+        profiler, self.profiler = self.profiler, None
+        profiler.disable()
+
+        file_path = self.get_report_path('Profile', 'prof')
+        profiler.dump_stats(file_path)
+
+        with open(file_path[:-len('prof')] + 'txt', 'w') as f:
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats('cumulative').print_stats(self.report_lines)
+
+        self.logger.info('Profile written to %s', file_path)
+
+    def write_report(self):
+        """
+        Write report of timings and lag of reactor.
+        """
+        file_path = self.get_report_path('Timings', 'txt')
+
+        with open(file_path, 'w') as f:
+            f.write(self.lag_monitor.format_report())
+            f.write('\n')
+            f.write(Timings().format_report())
+
+        self.logger.info('Timings written to %s', file_path)
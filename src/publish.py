@@ -0,0 +1,83 @@
+# -*- coding: utf8 -*-
+"""
+Provides class used to move finished files from scratch directory to their
+destination.
+"""
+
+import errno
+import logging
+import os
+import os.path
+import shutil
+import sys
+
+from twisted.internet import defer
+
+from config import Configuration
+from utils import async_function
+
+
+class Publisher(object):
+    """
+    Class that publishes files written to scratch directory. File is renamed
+    to its destination when it's on the same file system. Otherwise it's
+    copied next to destination under temporary name and then renamed, so
+    readers never see half-written file. Count of concurrent copies is limited
+    by configuration.
+    """
+    part_suffix = '.part'
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = Configuration()
+
+        workers = self.config.getint('output', 'publish_workers')
+        self.semaphore = defer.DeferredSemaphore(workers)
+
+    def publish(self, source, destination):
+        """
+        Move source file to destination.
+        @param source str, Path to file in scratch directory
+        @param destination str, Path to destination
+        @return t.i.d.Deferred
+        """
+        self.logger.debug('Publishing %s to %s', source, destination)
+        return self.semaphore.run(self._publish, source, destination)
+
+    @async_function
+    def _publish(self, source, destination):
+        try:
+            self._rename(source, destination)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+        part_file = destination + self.part_suffix
+        try:
+            shutil.copyfile(source, part_file)
+            self._rename(part_file, destination)
+        except:
+            if os.path.exists(part_file):
+                os.remove(part_file)
+            raise
+
+        os.remove(source)
+
+    def _rename(self, source, destination):
+        # rename doesn't replace existing file on win32
+        if sys.platform == 'win32' and os.path.exists(destination):
+            os.remove(destination)
+
+        os.rename(source, destination)
+
+    @async_function
+    def discard(self, source):
+        """
+        Remove file from scratch directory.
+        @param source str
+        @return t.i.d.Deferred
+        """
+        if os.path.exists(source):
+            os.remove(source)
@@ -0,0 +1,189 @@
+# -*- coding: utf8 -*-
+"""
+Provides class used to record results of finished tasks.
+"""
+
+import json
+import logging
+import os
+import os.path
+import threading
+import Queue as queue
+from datetime import datetime
+
+from twisted.internet import threads
+
+from config import Configuration
+from utils import get_app_dir
+
+
+class LineWriter(threading.Thread):
+    """
+    Thread that appends lines to file, so writing doesn't block reactor.
+    Lines are written in order of write calls. File is flushed when there is
+    no line waiting.
+    """
+    def __init__(self, file_path):
+        """
+        @param file_path str, Path to file
+        """
+        threading.Thread.__init__(self, name='LineWriter')
+        self.daemon = True
+
+        self.file_path = file_path
+        self.lines = queue.Queue()
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def write(self, line):
+        """
+        Enqueue line to write.
+        @param line str
+        """
+        self.lines.put(line)
+
+    def close(self):
+        """
+        Write remaining lines and stop thread.
+        @return t.i.d.Deferred
+        """
+        self.lines.put(None)
+        return threads.deferToThread(self.join)
+
+    def run(self):
+        try:
+            with open(self.file_path, 'a') as f:
+                while True:
+                    line = self.lines.get()
+                    if line is None:
+                        break
+
+                    f.write(line)
+
+                    if self.lines.empty():
+                        f.flush()
+        except:
+            self.logger.exception('Writing of %s failed', self.file_path)
+
+
+class ResultsLog(object):
+    """
+    Class that writes record of each finished task immediately as one line
+    of JSON to results log (one file per run in directory log in
+    application's directory). Record contains status, timings, return code
+    and excerpt of stderr of process.
+
+    Only counters of tasks per status and limited count of input files of
+    failed and incomplete tasks are kept in memory for final report.
+    """
+    statuses = ('done', 'incomplete', 'failed')
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = Configuration()
+
+        self.stderr_excerpt = self.config.getint('results', 'stderr_excerpt')
+        self.report_size = self.config.getint('results', 'report_size')
+
+        self.file_path = None
+        self.writer = None
+        self.reset()
+
+    def reset(self):
+        """
+        Reset counters.
+        """
+        self.counts = dict((status, 0) for status in self.statuses)
+        self.reported = dict((status, []) for status in self.statuses)
+
+    @property
+    def problems_count(self):
+        """
+        @return int, Count of failed and incomplete tasks
+        """
+        return self.counts['failed'] + self.counts['incomplete']
+
+    def open(self):
+        """
+        Reset counters and open new results log.
+        """
+        self.reset()
+
+        log_dir_path = os.path.join(get_app_dir(), 'log')
+        if not os.path.exists(log_dir_path):
+            os.mkdir(log_dir_path)
+
+        log_name = 'Results_%s.jsonl' % datetime.now()
+        # colon is not allowed in windows path
+        log_name = log_name.replace(':', '-')
+
+        self.file_path = os.path.join(log_dir_path, log_name)
+        self.logger.info('Writing results to %s', self.file_path)
+
+        self.writer = LineWriter(self.file_path)
+        self.writer.start()
+
+    def close(self):
+        """
+        Close results log when all records are written.
+        @return t.i.d.Deferred
+        """
+        writer, self.writer = self.writer, None
+        return writer.close()
+
+    def add(self, task, status):
+        """
+        Count finished task and write its record. Task finished after log
+        was closed (e.g. publishing completed after cancel) is only logged.
+        @param task Task
+        @param status str, done, incomplete or failed
+        """
+        if self.writer is None:
+            self.logger.warning('Results log is closed, task %s finished as '
+                                '%s is not recorded', task, status)
+            return
+
+        self.counts[status] += 1
+
+        reported = self.reported[status]
+        if status != 'done' and len(reported) < self.report_size:
+            reported.append(task.input_file)
+
+        line = json.dumps(self.make_record(task, status)) + '\n'
+        self.writer.write(line)
+
+    def make_record(self, task, status):
+        """
+        @param task Task
+        @param status str
+        @return dict, Record of finished task
+        """
+        process = task.process
+
+        stderr = None
+        if status != 'done' and process.stderr:
+            stderr = process.stderr[-self.stderr_excerpt:]
+
+        return {'status': status,
+                'input_file': task.input_file,
+                'sub_file': task.sub_file,
+                'output_file': task.output_file,
+                'queue': task.queue,
+                'priority': task.priority,
+                'threads': task.threads,
+                'queued_at': task.queued_at,
+                'start_time': process.start_time,
+                'end_time': process.end_time,
+                'run_time': process.get_run_time(),
+                'predicted_run_time': task.predicted_run_time,
+                'returncode': process.returncode,
+                'frames': process.frames,
+                'fps': process.fps,
+                'output_size': process.output_size,
+                'video_bitrate': process.video_bitrate,
+                'video_copy': process.video_copy,
+                'audio_copy': process.audio_copy,
+                'stalled': task.stalled,
+                'error': task.error,
+                'stderr': stderr}
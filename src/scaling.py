@@ -0,0 +1,118 @@
+# -*- coding: utf8 -*-
+"""
+Provides class used to choose resolution and bitrate of output video.
+"""
+
+import logging
+
+from config import Configuration
+
+
+class VideoScaling(object):
+    """
+    Class that computes size of output video and its bitrate from probed
+    size of input. Video larger than maximum resolution of profile is scaled
+    down to fit it, display aspect ratio of input is preserved and size is
+    rounded to multiple of 16. Bitrate is taken from tier with the smallest
+    height that is not lower than height of output, the highest tier is used
+    for larger or unknown size.
+    """
+    modulo = 16
+
+    def __init__(self, section='command'):
+        """
+        Read settings from section of configuration file.
+        @param section str, Section of conversion profile
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = Configuration()
+
+        self.max_size = self.parse_resolution(
+            self.config.get(section, 'max_resolution'))
+        self.tiers = self.parse_tiers(self.config.get(section,
+                                                      'bitrate_tiers'))
+
+    def parse_resolution(self, resolution_str):
+        """
+        @param resolution_str str, Resolution in format WIDTHxHEIGHT
+        @return tuple or None, (width, height) or None when not set or
+            invalid
+        """
+        if not resolution_str.strip():
+            return None
+
+        try:
+            width, height = [int(value)
+                             for value in resolution_str.lower().split('x')]
+        except ValueError:
+            self.logger.warning('Invalid resolution: %s', resolution_str)
+            return None
+
+        return (width, height)
+
+    def parse_tiers(self, tiers_str):
+        """
+        Parse tiers in format 'height=bitrate; height=bitrate'.
+        @param tiers_str str
+        @return list, List of tuples (height, bitrate) sorted by height
+        """
+        tiers = []
+
+        for item in tiers_str.split(';'):
+            if not item.strip():
+                continue
+
+            height, sep, bitrate = item.partition('=')
+            try:
+                tiers.append((int(height), int(bitrate)))
+            except ValueError:
+                self.logger.warning('Invalid bitrate tier: %s', item)
+
+        return sorted(tiers)
+
+    def round_size(self, value):
+        return max(self.modulo, int(round(float(value) / self.modulo)) * self.modulo)
+
+    def get_output_size(self, info):
+        """
+        Return size of scaled output or None when video isn't scaled.
+        @param info MediaInfo or None
+        @return tuple or None, (width, height)
+        """
+        if (self.max_size is None or info is None or not info.width
+                or not info.height):
+            return None
+
+        max_width, max_height = self.max_size
+        if info.width <= max_width and info.height <= max_height:
+            return None
+
+        aspect = info.aspect or float(info.width) / info.height
+        width = min(max_width, max_height * aspect)
+        height = width / aspect
+
+        return (self.round_size(width), self.round_size(height))
+
+    def get_video_bitrate(self, info):
+        """
+        Return bitrate for height of output.
+        @param info MediaInfo or None
+        @return int or None, Bitrate in kbit/s or None when no tier is set
+        """
+        if not self.tiers:
+            return None
+
+        size = self.get_output_size(info)
+        if size is not None:
+            height = size[1]
+        elif info is not None and info.height:
+            height = info.height
+        else:
+            return self.tiers[-1][1]
+
+        for tier_height, bitrate in self.tiers:
+            if height <= tier_height:
+                return bitrate
+
+        return self.tiers[-1][1]
@@ -6,6 +6,7 @@ Provides classes used to schedule tasks.
 import logging
 import os
 import sys
+import time
 
 from decimal import Decimal
 
@@ -13,9 +14,23 @@ from twisted.internet import defer
 from twisted.internet import task as tx_task
 from twisted.python import failure
 
+from admission import DiskSpaceAdmission, DeviceAdmission, ThreadBudget
+from affinity import CpuAffinity
+from calibration import Calibrator
 from config import Configuration
+from fairshare import FairShare
+from history import EncodeHistory
+from memory import MemoryMonitor
+from prefetch import Prefetcher
+from profiling import timed
+from probe import MediaProber
 from process import ConversionProcess
+from publish import Publisher
+from results import ResultsLog
+from throttle import CpuThrottle
+from timeline import TimelineRecorder
 from utils import async_function
+from watchdog import StallWatchdog
 
 
 class Queue(object):
@@ -42,6 +57,22 @@ class Queue(object):
     def append(self, row):
         self.liststore.append(row)
 
+    def reorder(self, new_order):
+        """
+        Reorder rows by one permutation.
+        @param new_order list, Old positions of rows in their new order
+        """
+        self.liststore.reorder(new_order)
+
+    def remove_paths(self, paths):
+        """
+        Remove rows on given paths.
+        @param paths list, List of paths
+        """
+        iters = [self.liststore.get_iter(path) for path in paths]
+        for iter_ in iters:
+            self.liststore.remove(iter_)
+
     def remove(self, row):
         for i in range(len(self.liststore)):
             path = (i,)
@@ -61,7 +92,8 @@ class QueueRow(object):
     Wrapper around gtk.TreeModelRow used in GUI.
     """
     column_map = {'id': 0,  'file_path': 1, 'sub_path': 2, 'has_sub': 3,
-                  'subpix': 4, 'running': 5}
+                  'subpix': 4, 'running': 5, 'priority': 6, 'queue': 7,
+                  'queued_at': 8}
 
     def __init__(self, row):
         self.row = row
@@ -95,8 +127,20 @@ class Task(object):
     input_file = None
     sub_file = None
     output_file = None
+    work_file = None
+    read_file = None
     row_id = None
+    priority = None
+    queue = None
+    queued_at = None
+    error = None
+    media_info = None
     process = None
+    slot = None
+    cpus = None
+    threads = None
+    stalled = False
+    predicted_run_time = None
 
     def __str__(self):
         return "<Task '%s'>" % self.input_file
@@ -114,14 +158,42 @@ class Scheduler(object):
        available count to queue and ran conversion. And then added next files.
        In this case scheduler check new files and schedule tasks.
 
-    When scheduler is selecting new task from queue, takes top row that is not
-    marked as running. Then new process is started and task is marked as runnig.
-    Task is removed from queue and according to status of process added to
-    tasks_done, tasks_incomplete or tasks_failed after finish of process.
+    When scheduler is selecting new task from queue, takes top row with the
+    highest priority that is not marked as running and is admitted by
+    admission controls (e.g. there is enough disk space for its output, its
+    devices are not saturated and there is enough of memory). Other tasks are
+    held in queue and following tasks are tried. Input files are probed
+    before admission. Then new process is started in free slot and task is
+    marked as runnig. Processes in slots could be pinned to CPU cores.
+    Task is removed from queue after finish of process and according to
+    status of process it's counted as done, incomplete or failed and written
+    to results log.
+    When scratch directory is configured, processes write to it and finished
+    files are published to their destination in background. Input files of
+    next tasks could be prefetched.
+
+    Tasks belong to named queues which share slots according to their weights
+    (see FairShare), tasks with the same priority are taken from queues in
+    weighted round-robin. Count of running tasks of each queue could be
+    limited.
+
+    When all slots are occupied and task with higher priority than some
+    running task is waiting, running task with the lowest priority is
+    preempted, i.e. its process is suspended and its slot is given to the
+    waiting task. Preempted task is resumed when a slot is free and no
+    waiting task has higher priority.
+
+    Hanging processes are detected by watchdog. Stalled process is aborted
+    and its slot is freed immediately. Stalled task is returned to queue
+    until count of its retries is exhausted, then it's failed.
 
     Scheduler supports this operations: start, cancel, pause and resume. They
-    are propagated to running processes. State of of scheduler could be checked
+    are propagated to running processes. Single task could be cancelled or
+    its priority could be changed. CPU usage of running processes could
+    be limited by throttling. State of of scheduler could be checked
     by this properties: running, paused, cancelled.
+
+    Listeners are notified about events of scheduler and tasks (see emit).
     """
     def __init__(self, tasks_queue):
         """
@@ -136,19 +208,51 @@ class Scheduler(object):
         self._paused = False
         self._cancelled = False
         self.processes = set()
-        self.tasks_done = []
-        self.tasks_incomplete = []
-        self.tasks_failed = []
+        self.results = ResultsLog()
 
         self.scheduler = tx_task.LoopingCall(self.schedule_tasks)
         self.deferred = defer.Deferred()
 
+        self.listeners = []
+
+        self.timeline = TimelineRecorder()
+        if self.timeline.enabled:
+            self.add_listener(self.timeline.record)
+
+        self.throttle = CpuThrottle(self.processes)
+
         self.config = Configuration()
 
         self.processes_count = self.config.getint('scheduler',
                                                   'processes_count')
         self.logger.debug('Count of processes to run: %s', self.processes_count)
 
+        self.slots = [None] * self.processes_count
+        self.preempted_tasks = []
+        self.affinity = CpuAffinity(self.processes_count)
+
+        self.prober = MediaProber()
+        self.history = EncodeHistory()
+        self.calibrator = Calibrator()
+        self.memory = MemoryMonitor(self.processes)
+        self.fairshare = FairShare()
+        self.thread_budget = ThreadBudget(self.slots)
+        self.admissions = [self.fairshare, self.thread_budget,
+                           DiskSpaceAdmission(), DeviceAdmission(),
+                           self.memory]
+        self.held_rows = set()
+
+        self.scratch_dir = self.config.get('output', 'scratch_dir')
+        self.logger.debug('Scratch directory: %s', self.scratch_dir)
+        self.publisher = Publisher()
+        self.publishing = set()
+
+        self.prefetcher = Prefetcher()
+
+        self.watchdog = StallWatchdog(self.task_stalled)
+        self.stalled_tasks = set()
+        self.retries = {}
+
         self.scheduler_timeout = self.config.getint('scheduler',
                                                     'scheduler_timeout')
         self.logger.debug('Scheduler timeout: %s', self.scheduler_timeout)
@@ -174,11 +278,20 @@ class Scheduler(object):
 
         self._running = True
 
-        self.reset_finished_tasks()
+        self.results.open()
+        self.history.load()
+        self.retries.clear()
+        self.fairshare.reset()
 
         self.logger.debug('Starting scheduler')
+        self.emit('scheduler_started')
+
         d = self.scheduler.start(self.scheduler_timeout)
 
+        self.throttle.start()
+        self.memory.start()
+        self.watchdog.start()
+
         def scheduler_stopped(res):
             """
             Called when LoopingCall is stopped. Reset scheduler state and
@@ -186,15 +299,28 @@ class Scheduler(object):
             """
             self.logger.debug('Scheduler stopped')
 
+            self.fairshare.log_stats()
+
+            self.throttle.stop()
+            self.memory.stop()
+            self.watchdog.stop()
+            self.prefetcher.stop()
+
             # reset previous state
             self._running = False
             self._paused = False
             self._cancelled = False
 
+            self.emit('scheduler_stopped', **self.results.counts)
+
             # set NEW deferred
             d, self.deferred = self.deferred, defer.Deferred()
 
-            d.callback(None)
+            # callback when all results are written
+            d_results = self.results.close()
+            d_results.addErrback(lambda fail: self.logger.error(
+                'Closing of results log failed: %s', fail.getErrorMessage()))
+            d_results.addCallback(lambda _: d.callback(None))
 
         d.addBoth(scheduler_stopped)
 
@@ -226,6 +352,8 @@ class Scheduler(object):
         for process in self.processes:
             process.pause()
 
+        self.emit('scheduler_paused')
+
     def resume(self):
         """
         Resume scheduler and paused processes.
@@ -235,16 +363,145 @@ class Scheduler(object):
         self._paused = False
 
         for process in self.processes:
-            process.resume()
+            # calibration could start while scheduler was paused
+            if process.paused:
+                process.resume()
+
+        self.emit('scheduler_resumed')
+
+    def set_cpu_target(self, cpu_target):
+        """
+        Set CPU share of running processes in percent of whole machine. When
+        target is None, processes are not throttled.
+        @param cpu_target int or None
+        """
+        self.throttle.set_cpu_target(cpu_target)
+
+    def add_listener(self, listener):
+        """
+        Register listener of events.
+        @param listener callable, Called with dict describing event
+        """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """
+        Unregister listener of events.
+        @param listener callable
+        """
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def emit(self, event, task=None, **data):
+        """
+        Notify listeners about event. Event is passed as dict with keys event,
+        time, information about task (if any) and additional data. Failures
+        of listeners are logged and ignored.
+        @param event str, Name of event, e.g. task_started
+        @param task Task, Task concerned by event
+        @param data dict, Additional data of event
+        """
+        record = {'event': event, 'time': time.time()}
+        if task is not None:
+            record.update({'row_id': task.row_id,
+                           'input_file': task.input_file,
+                           'queue': task.queue,
+                           'priority': task.priority})
+        record.update(data)
+
+        for listener in list(self.listeners):
+            try:
+                listener(record)
+            except:
+                self.logger.exception('Listener of event %s failed', event)
+
+    def cancel_task(self, row_id):
+        """
+        Cancel single task. Running process of task is terminated. Task's row
+        is removed from queue.
+        @param row_id int, ID of row
+        @return bool, False if row was not found
+        """
+        row = self.get_row_by_id(row_id)
+        if row is None:
+            return False
+
+        task = self.get_running_task(row_id)
+        if task is not None:
+            self.logger.info('Cancelling running task %s', task)
+            task.process.terminate()
+            self.emit('task_cancelled', task)
+        else:
+            self.logger.info('Removing task %s from queue', row['file_path'])
+            self.emit('task_cancelled', self.make_task(row))
+
+        self.tasks_queue.remove(row)
+
+        return True
+
+    def set_task_priority(self, row_id, priority):
+        """
+        Change priority of task and reschedule, so task could preempt
+        running ones.
+        @param row_id int, ID of row
+        @param priority int
+        @return bool, False if row was not found
+        """
+        row = self.get_row_by_id(row_id)
+        if row is None:
+            return False
+
+        row['priority'] = priority
+
+        task = self.get_running_task(row_id)
+        if task is not None:
+            task.priority = priority
+
+        self.reschedule(None)
+
+        return True
+
+    def get_running_tasks(self):
+        """
+        Return tasks whose processes are running, including preempted and
+        stalled ones.
+        @return list, List of Task
+        """
+        tasks = [task for task in self.slots if task is not None]
+        return tasks + self.preempted_tasks + list(self.stalled_tasks)
+
+    def get_running_task(self, row_id):
+        """
+        @param row_id int, ID of row
+        @return Task or None, Running task of row or None if row isn't running
+        """
+        for task in self.get_running_tasks():
+            if task.row_id == row_id:
+                return task
+
+        return None
 
-    def reset_finished_tasks(self):
+    def get_task_state(self, row_id):
         """
-        Clear lists with tasks marked as done, failed and incomplete.
+        Return state of task in queue: queued, held (refused by admission
+        control), running, preempted or stalled.
+        @param row_id int, ID of row
+        @return str or None, None if row is not in queue
         """
-        del self.tasks_done[:]
-        del self.tasks_failed[:]
-        del self.tasks_incomplete[:]
+        row = self.get_row_by_id(row_id)
+        if row is None:
+            return None
+
+        task = self.get_running_task(row_id)
+        if task is None:
+            return 'held' if row_id in self.held_rows else 'queued'
+        if task.stalled:
+            return 'stalled'
+        if task in self.preempted_tasks:
+            return 'preempted'
+        return 'running'
 
+    @timed('Scheduler.schedule_tasks')
     def schedule_tasks(self):
         """
         Try to schedule tasks. If scheduler is not running or is cancelled or
@@ -265,35 +522,136 @@ class Scheduler(object):
 
         self.logger.debug('Schedule tasks')
 
-        def reschedule(res):
-            """
-            Reschedule immediately after process was finished. When scheduler is
-            not running do nothing.
-            """
-            if self.running:
-                self.logger.debug('Reschedule immediately')
-                self.schedule_tasks()
-
         while self.can_schedule_task():
-            task = self.get_top_task()
+            if None in self.slots:
+                task = self.get_top_task() if self.has_tasks() else None
+                preempted = self.get_top_preempted_task()
+
+                if preempted is not None and (task is None or
+                                              preempted.priority >= task.priority):
+                    # resumed task keeps its count of threads
+                    if not self.thread_budget.admit_resumed(preempted):
+                        break
+
+                    self.resume_preempted_task(preempted)
+                    continue
+            else:
+                victim = self.get_preemption_victim()
+                if victim is None:
+                    break
+
+                task = self.get_top_task()
+                if task is None or task.priority <= victim.priority:
+                    break
+
+                self.preempt_task(victim)
+
+            if task is None:
+                break  # remaining tasks are probed or held
+
             self.logger.debug('Task: %s', task)
 
             d = self.start_process(task)
-            d.addBoth(reschedule)  # don't wait for timeout, schedule now
+            d.addBoth(self.reschedule)  # don't wait for timeout, schedule now
+
+        upcoming_files = [row['file_path']
+                          for row in self.get_rows_by_priority()]
+        self.prefetcher.update(upcoming_files)
+
+    def reschedule(self, result):
+        """
+        Reschedule immediately after process was finished or state of some
+        task was changed. When scheduler is not running do nothing.
+        @param result object, Passed result
+        @return object
+        """
+        if self.running:
+            self.logger.debug('Reschedule immediately')
+            self.schedule_tasks()
+
+        return result
 
     def nothing_to_schedule(self):
         """
         @return bool, True if we have no task to schedule nor running process,
         otherwise False
         """
-        return len(self.processes) == 0 and not self.has_tasks()
+        return (len(self.processes) == 0 and not self.has_tasks()
+                and not self.publishing and not self.stalled_tasks)
 
     def can_schedule_task(self):
         """
-        @return bool, True if we have tasks in queue and can start new
-        processes, otherwise False
+        @return bool, True if we have tasks in queue or preempted tasks,
+        otherwise False
+        """
+        return self.has_tasks() or len(self.preempted_tasks) > 0
+
+    def get_top_preempted_task(self):
+        """
+        Return preempted task with the highest priority, the earliest
+        preempted one from tasks with the same priority.
+        @return Task or None
+        """
+        if not self.preempted_tasks:
+            return None
+
+        return max(self.preempted_tasks, key=lambda task: task.priority)
+
+    def get_preemption_victim(self):
         """
-        return len(self.processes) < self.processes_count and self.has_tasks()
+        Return running task which would be preempted by waiting task with the
+        highest priority, i.e. running task with the lowest priority, the
+        latest started one from tasks with the same priority.
+        @return Task or None, None if no running task has lower priority than
+            waiting tasks
+        """
+        rows = self.get_rows_by_priority()
+        if not rows:
+            return None
+
+        top_priority = rows[0]['priority']
+
+        running_tasks = [task for task in self.slots if task is not None]
+        if not running_tasks:
+            return None
+
+        victim = min(running_tasks, key=lambda task: (task.priority,
+                                                      -task.process.start_time))
+
+        return victim if victim.priority < top_priority else None
+
+    def preempt_task(self, task):
+        """
+        Suspend process of running task and free its slot.
+        @param task Task
+        """
+        self.logger.info('Preempting task %s (priority %s)', task,
+                         task.priority)
+
+        task.process.hold('preempt')
+
+        self.slots[task.slot] = None
+        self.preempted_tasks.append(task)
+
+        self.emit('task_preempted', task, slot=task.slot)
+
+    def resume_preempted_task(self, task):
+        """
+        Give free slot to preempted task and resume its process.
+        @param task Task
+        """
+        self.logger.info('Resuming preempted task %s (priority %s)', task,
+                         task.priority)
+
+        self.preempted_tasks.remove(task)
+
+        task.slot = self.slots.index(None)
+        self.slots[task.slot] = task
+        self.affinity.rebalance(self.slots)
+
+        task.process.release('preempt')
+
+        self.emit('task_resumed', task, slot=task.slot)
 
     def stop_scheduler(self):
         """
@@ -310,24 +668,119 @@ class Scheduler(object):
         @param task Task, Task to process
         @return t.i.d.Deferred
         """
-        process = ConversionProcess(task.input_file,
+        task.read_file = self.prefetcher.acquire(task.input_file)
+
+        # other rows waiting for start, row of task isn't marked running yet
+        waiting_count = len(self.get_rows_not_running()) - 1
+        task.threads = self.thread_budget.assign_threads(waiting_count)
+
+        process = ConversionProcess(task.read_file,
                                     task.sub_file,
-                                    task.output_file)
+                                    task.work_file,
+                                    media_info=task.media_info,
+                                    threads=task.threads)
 
         self.logger.debug('Created new process object: %s', process)
 
+        task.slot = self.slots.index(None)
+        self.slots[task.slot] = task
+
         process.run()
         self.processes.add(process)
 
         task.process = process
+        task.predicted_run_time = self.get_predicted_run_time(
+            task.input_file, task.media_info)
 
         self.set_task_started(task)
+        self.affinity.rebalance(self.slots)
+
+        for admission in self.admissions:
+            admission.task_started(task)
+
+        self.watchdog.watch(task)
+
+        if process.video_copy or process.audio_copy:
+            self.logger.info('Task %s copies streams: video %s, audio %s',
+                             task, process.video_copy, process.audio_copy)
+
+        self.emit('task_started', task, slot=task.slot, cpus=task.cpus,
+                  threads=task.threads, pid=process.pid,
+                  queued_at=task.queued_at, video_copy=process.video_copy,
+                  audio_copy=process.audio_copy,
+                  predicted_run_time=task.predicted_run_time)
 
         process.deferred.addBoth(self.task_finished, task)
-        process.deferred.addBoth(lambda _: self.processes.remove(process))
+        process.deferred.addBoth(self.release_slot, task)
 
         return process.deferred
 
+    def release_slot(self, result, task):
+        """
+        Remove task's process from running processes, free its slot and
+        rebalance CPUs of remaining processes.
+        @param result object, Result of process's deferred
+        @param task Task
+        @return object, Passed result
+        """
+        self.processes.discard(task.process)
+        self.prefetcher.release(task.input_file)
+        self.watchdog.unwatch(task)
+
+        if self.slots[task.slot] is task:
+            self.slots[task.slot] = None
+
+        if task in self.preempted_tasks:
+            self.preempted_tasks.remove(task)
+
+        self.affinity.rebalance(self.slots)
+
+        for admission in self.admissions:
+            admission.task_finished(task)
+
+        return result
+
+    def task_stalled(self, task, reason):
+        """
+        Callbacked by watchdog when process of task is stalled. Abort the
+        process and free its slot immediately, task is finished when process
+        exits.
+        @param task Task
+        @param reason str, Description of stall
+        """
+        task.stalled = True
+        task.error = 'Process stalled: %s' % reason
+
+        self.stalled_tasks.add(task)
+
+        task.process.abort(self.watchdog.kill_delay)
+        self.release_slot(None, task)
+
+        self.emit('task_stalled', task, reason=reason)
+
+        self.reschedule(None)
+
+    def retry_stalled_task(self, task):
+        """
+        Return stalled task to queue if count of its retries is not exhausted.
+        @param task Task
+        @return bool, True if task is retried
+        """
+        retries = self.retries.get(task.row_id, 0)
+        if retries >= self.watchdog.retries:
+            return False
+
+        self.retries[task.row_id] = retries + 1
+        self.logger.warning('Retrying stalled task %s (%d/%d)', task,
+                            retries + 1, self.watchdog.retries)
+
+        row = self.get_row_by_id(task.row_id)
+        row['running'] = False
+
+        self.emit('task_retried', task, retry=retries + 1)
+
+        return True
+
     def has_tasks(self):
         """
         @return bool, True queue contains (non running) tasks, otherwise False
@@ -336,30 +789,144 @@ class Scheduler(object):
 
     def get_top_task(self):
         """
-        Return top task in queue that is not set as running.
-        @return Task
+        Return top task with the highest priority in queue that is not set as
+        running and could be started now. Tasks refused by admission controls are held in queue
+        and following tasks are tried. When task whose input file was not
+        probed yet is reached, return None and reschedule after probe, so
+        order of queue is kept. Tasks being calibrated are skipped and
+        scheduler is rescheduled after calibration.
+        @return Task or None
         """
-        rows = self.get_rows_not_running()
+        for row in self.get_rows_by_priority():
+            task = self.make_task(row)
+
+            task.media_info = self.prober.get_cached_info(task.input_file)
+            if task.media_info is None:
+                self.logger.debug('Probing task: %s', task)
+                self.emit('task_probing', task)
+                d = self.prober.probe(task.input_file)
+                d.addCallback(self.task_probed, task)
+                d.addCallback(self.reschedule)
+                return None
+
+            if self.calibrator.needs_calibration(task.media_info):
+                # following tasks could start while task is calibrated
+                if not self.calibrator.is_pending(task.input_file):
+                    self.logger.debug('Calibrating task: %s', task)
+                    d = self.calibrator.calibrate(task.input_file,
+                                                  task.sub_file,
+                                                  task.work_file,
+                                                  task.media_info,
+                                                  self.processes)
+                    d.addCallback(self.reschedule)
+                continue
+
+            if self.admit_task(task):
+                return task
 
-        if len(rows) == 0:
-            return None
+        return None
 
-        row = rows[0]
+    def task_probed(self, result, task):
+        """
+        Callbacked when input file of task is probed.
+        @param result object, Result of probe
+        @param task Task
+        @return object, result
+        """
+        self.emit('task_probed', task)
+        return result
 
+    def make_task(self, row):
+        """
+        Create task from row of queue.
+        @param row QueueRow
+        @return Task
+        """
         input_file_name = row['file_path']
         output_file_name = self.extend_file_name(input_file_name)
 
-        self.logger.debug('Input file: %s, output file: %s', input_file_name,
-                          output_file_name)
-
         task = Task()
         task.input_file = input_file_name
         task.sub_file = row['sub_path']
         task.output_file = output_file_name
         task.row_id = row['id']
+        task.priority = row['priority']
+        task.queue = row['queue']
+        task.queued_at = row['queued_at']
+
+        if self.scratch_dir:
+            work_file_name = '%d_%s' % (task.row_id,
+                                        os.path.basename(output_file_name))
+            task.work_file = os.path.join(self.scratch_dir, work_file_name)
+        else:
+            task.work_file = output_file_name
 
         return task
 
+    def admit_task(self, task):
+        """
+        Ask admission controls whether task could be started. Log change of
+        task's state. Task whose files can't be examined by admission control
+        (e.g. missing input file) is held too, so other tasks are scheduled.
+        @param task Task
+        @return bool
+        """
+        for admission in self.admissions:
+            error = None
+            try:
+                admitted = admission.admit(task)
+            except OSError as e:
+                admitted = False
+                error = e
+
+            if not admitted:
+                if task.row_id not in self.held_rows:
+                    name = admission.__class__.__name__
+                    if error is not None:
+                        self.logger.warning('Task %s held by %s: %s', task,
+                                            name, error)
+                    else:
+                        self.logger.info('Task %s held by %s', task, name)
+                    self.held_rows.add(task.row_id)
+                    self.emit('task_held', task, admission=name)
+                return False
+
+        if task.row_id in self.held_rows:
+            self.logger.info('Task %s admitted', task)
+            self.held_rows.discard(task.row_id)
+            self.emit('task_admitted', task)
+
+        self.logger.debug('Input file: %s, output file: %s, work file: %s',
+                          task.input_file, task.output_file, task.work_file)
+
+        return True
+
+    def predict_run_time(self, row):
+        """
+        Estimate run time of task from its calibration or from history of
+        conversions. Input file must be already probed.
+        @param row QueueRow
+        @return float or None, Time in seconds or None when it can't be
+            estimated
+        """
+        info = self.prober.get_cached_info(row['file_path'])
+        return self.get_predicted_run_time(row['file_path'], info)
+
+    def get_predicted_run_time(self, input_file, info):
+        """
+        Estimate run time of conversion of input file by its calibration or
+        from history of conversions.
+        @param input_file str
+        @param info MediaInfo or None
+        @return float or None, Time in seconds or None when it can't be
+            estimated
+        """
+        calibration = self.calibrator.get_cached(input_file)
+        if calibration is not None:
+            return calibration.run_time
+
+        return self.history.predict_run_time(info)
+
     def get_rows_not_running(self):
         """
         Return rows in queue that are not marked as running. Rows are sorted
@@ -374,6 +941,15 @@ class Scheduler(object):
 
         return rows_not_running
 
+    def get_rows_by_priority(self):
+        """
+        Return rows in queue that are not marked as running. Rows are sorted
+        by priority from the highest, rows with the same priority are sorted
+        by fair share of their queues and then from top to bottom.
+        @return list, List of rows (type QueueRow)
+        """
+        return self.fairshare.sort_rows(self.get_rows_not_running())
+
     def set_task_started(self, task):
         """
         Mark task as running.
@@ -394,46 +970,132 @@ class Scheduler(object):
 
         return None
 
+    @timed('Scheduler.task_finished')
     @defer.inlineCallbacks
     def task_finished(self, result, task):
         """
         Callbacked when process is finished. If deferred has beed cancelled
-        return immediately. Otherwise get status of process and append task to
-        tasks_done, tasks_incomplete or tasks_failed. Remove task's row from
-        queue.
+        return immediately. Otherwise get status of process (done, incomplete
+        or failed) and record finished task. Remove task's row from queue.
         @return t.i.d.Deferred
         """
 
+        self.stalled_tasks.discard(task)
+
         cancelled = (isinstance(result, failure.Failure)
                      and isinstance(result.value, defer.CancelledError))
         if cancelled:
             self.logger.debug('Task cancelled: %s', task)
+            if task.work_file != task.output_file:
+                # partial output in scratch directory
+                d = self.publisher.discard(task.work_file)
+                d.addErrback(lambda fail: self.logger.warning(
+                    'Removing of %s failed: %s', task.work_file,
+                    fail.getErrorMessage()))
             defer.returnValue(None)
 
         returncode = task.process.returncode
         self.logger.debug('Task %s finished with return code: %s', task,
                           returncode)
-
-        if returncode == 0:
+        self.logger.info('Task %s ran in slot %s on CPUs %s with %s threads: '
+                         '%s frames in %.1f s, %s fps', task, task.slot,
+                         task.cpus, task.threads,
+                         task.process.frames,
+                         task.process.end_time - task.process.start_time,
+                         task.process.fps)
+        if task.predicted_run_time is not None:
+            self.logger.debug('Predicted run time of task %s was %.1f s',
+                              task, task.predicted_run_time)
+
+        process = task.process
+        self.emit('task_exited', task, returncode=returncode,
+                  start_time=process.start_time, end_time=process.end_time,
+                  first_output=process.first_output_time,
+                  frames=process.frames)
+
+        if task.stalled:
+            if self.retry_stalled_task(task):
+                defer.returnValue(result)
+
+            status = 'failed'
+        elif returncode == 0:
             # FIXME: doesn't work on win32 platform
             if sys.platform != 'win32':
                 is_complete = yield self.is_task_complete(task)
+                self.emit('task_verified', task, complete=is_complete)
 
                 if is_complete:
-                    self.tasks_done.append(task)
+                    status = 'done'
                 else:
                     self.logger.warning('Task %s seems be incomplete', task)
-                    self.tasks_incomplete.append(task)
+                    status = 'incomplete'
             else:
-                self.tasks_done.append(task)
+                status = 'done'
         else:
-            self.tasks_failed.append(task)
+            status = 'failed'
 
+        # row is already removed when task was cancelled after its process
+        # exited
         row = self.get_row_by_id(task.row_id)
-        self.tasks_queue.remove(row)
+        if row is not None:
+            self.tasks_queue.remove(row)
+
+        if task.work_file != task.output_file:
+            self.publish_task(task, status)
+        else:
+            self.add_finished_task(task, status)
 
         defer.returnValue(result)
 
+    def add_finished_task(self, task, status):
+        """
+        Write finished task to results log and notify listeners.
+        @param task Task
+        @param status str, done, incomplete or failed
+        """
+        self.results.add(task, status)
+        if status == 'done':
+            self.history.add(task)
+
+        process = task.process
+        self.emit('task_finished', task, status=status,
+                  returncode=process.returncode, error=task.error,
+                  start_time=process.start_time, end_time=process.end_time,
+                  run_time=process.get_run_time(), frames=process.frames,
+                  fps=process.fps)
+
+    def publish_task(self, task, status):
+        """
+        Move output of task from scratch directory to its destination in
+        background and then record finished task. Output of failed task is
+        removed. When publishing fails, task is failed.
+        @param task Task
+        @param status str, done, incomplete or failed
+        """
+        if status == 'failed':
+            d = self.publisher.discard(task.work_file)
+        else:
+            d = self.publisher.publish(task.work_file, task.output_file)
+
+        self.publishing.add(d)
+        self.emit('task_publishing', task, status=status)
+
+        def published(res):
+            self.add_finished_task(task, status)
+
+        def publish_failed(fail):
+            self.logger.error('Publishing of task %s failed: %s', task,
+                              fail.getErrorMessage())
+            task.error = 'Publishing failed: %s' % fail.getErrorMessage()
+            self.add_finished_task(task, 'failed')
+
+        def publish_finished(res):
+            self.publishing.discard(d)
+            self.reschedule(None)
+
+        d.addCallbacks(published, publish_failed)
+        d.addBoth(publish_finished)
+
     @async_function
     def is_task_complete(self, task):
         """
@@ -443,7 +1105,7 @@ class Scheduler(object):
         @return t.i.d.Deferred, bool
         """
         input_file_stat = os.stat(task.input_file)
-        output_file_stat = os.stat(task.output_file)
+        output_file_stat = os.stat(task.work_file)
 
         input_file_size = input_file_stat.st_size
         output_file_size = output_file_stat.st_size
@@ -470,7 +1132,9 @@ class Scheduler(object):
         return new_file_name
 
     def stop_running_processes(self):
-        "Stop every running process."
+        "Stop every running process, including calibrations."
+        self.calibrator.cancel()
+
         while True:
             try:
                 process = self.processes.pop()
@@ -479,6 +1143,12 @@ class Scheduler(object):
             except KeyError:
                 break
 
+        for task in list(self.stalled_tasks):
+            task.process.terminate()
+
+        self.slots[:] = [None] * self.processes_count
+        del self.preempted_tasks[:]
+
     def reset_tasks_queue(self):
         """
         Reset queue to new processing, i.e. mark running rows as non-running.
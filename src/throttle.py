@@ -0,0 +1,130 @@
+# -*- coding: utf8 -*-
+"""
+Provides class used to limit CPU usage of running processes.
+"""
+
+import logging
+
+from twisted.internet import reactor
+from twisted.internet import task as tx_task
+
+from config import Configuration
+
+
+class CpuThrottle(object):
+    """
+    Class that keeps total CPU share of running processes near to target by
+    duty cycling. In every period all processes are released and after
+    the computed part of period they are suspended again. Processes are held
+    with reason 'throttle', so pausing of scheduler is not affected.
+
+    Target is given in percent of whole machine. Each process is supposed to
+    use as many cores as threads of its encoder (at most all cores), processes
+    held for other reasons (suspended, preempted) or paused are not counted.
+    """
+    hold_reason = 'throttle'
+
+    def __init__(self, processes):
+        """
+        Store set of processes to throttle and set object's attributes.
+        @param processes set, Set of running ConversionProcess objects
+        """
+        self.processes = processes
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = Configuration()
+
+        self.period = self.config.getfloat('throttle', 'period')
+
+        self.cpu_target = None
+        if self.config.getboolean('throttle', 'enabled'):
+            self.cpu_target = self.config.getint('throttle', 'cpu_target')
+        self.logger.debug('CPU target: %s', self.cpu_target)
+
+        self.looping_call = tx_task.LoopingCall(self.cycle)
+        self.hold_call = None
+
+    @property
+    def running(self):
+        return self.looping_call.running
+
+    def set_cpu_target(self, cpu_target):
+        """
+        Change target live. When target is None throttling is disabled.
+        @param cpu_target int or None, Target in percent of whole machine
+        """
+        self.logger.info('Setting CPU target to %s', cpu_target)
+        self.cpu_target = cpu_target
+
+        if cpu_target is None:
+            self.release_processes()
+
+    def start(self):
+        """
+        Start duty cycling.
+        """
+        if not self.running:
+            self.looping_call.start(self.period)
+
+    def stop(self):
+        """
+        Stop duty cycling and release all processes.
+        """
+        if self.running:
+            self.looping_call.stop()
+
+        self.release_processes()
+
+    def get_duty_cycle(self):
+        """
+        Return part of period when processes are allowed to run.
+        @return float, Number between 0 and 1
+        """
+        import psutil
+
+        if self.cpu_target is None:
+            return 1.0
+
+        used_cores = sum(process.threads or 1 for process in self.processes
+                         if process.started and not process.finished
+                         and not process.holds and not process.paused)
+        if not used_cores:
+            return 1.0
+
+        used_cores = min(used_cores, psutil.NUM_CPUS)
+        duty_cycle = (self.cpu_target / 100.0) * psutil.NUM_CPUS / used_cores
+
+        return min(1.0, duty_cycle)
+
+    def cycle(self):
+        """
+        Release processes and plan their suspension in current period.
+        """
+        self.release_processes()
+
+        duty_cycle = self.get_duty_cycle()
+        if duty_cycle < 1.0:
+            self.hold_call = reactor.callLater(duty_cycle * self.period,
+                                               self.hold_processes)
+
+    def hold_processes(self):
+        """
+        Suspend all running processes.
+        """
+        self.hold_call = None
+
+        for process in self.processes:
+            if process.started and not process.finished:
+                process.hold(self.hold_reason)
+
+    def release_processes(self):
+        """
+        Cancel planned suspension and resume all processes.
+        """
+        if self.hold_call is not None and self.hold_call.active():
+            self.hold_call.cancel()
+        self.hold_call = None
+
+        for process in self.processes:
+            process.release(self.hold_reason)
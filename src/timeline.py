@@ -0,0 +1,277 @@
+# -*- coding: utf8 -*-
+"""
+Provides class used to record timeline of conversion in Chrome trace format.
+"""
+
+import json
+import logging
+import os
+import os.path
+from datetime import datetime
+
+from config import Configuration
+from utils import async_function, get_app_dir
+
+
+class TimelineRecorder(object):
+    """
+    Listener of scheduler's events that records lifecycle of each task as
+    spans: queued, probe, held (until admitted), running in slot (split when
+    task is preempted), preempted, verify and publish; start of process and
+    its first output are marked too. Pauses of scheduler are recorded on
+    separate track.
+
+    Timeline of run is written when scheduler stops as JSON in Chrome
+    trace-event format (chrome://tracing, Perfetto) to directory trace in
+    application's directory. Process "slots" has one track per slot of
+    scheduler, process "queue" has one track per task.
+    """
+    slots_pid = 1
+    queue_pid = 2
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = Configuration()
+
+        self.enabled = self.config.getboolean('timeline', 'enabled')
+
+        self.reset()
+
+    def reset(self):
+        self.events = []
+        self.task_states = {}
+        self.pause_start = None
+        self.run_start = None
+
+    def record(self, event):
+        """
+        Listener of scheduler.
+        @param event dict, Event of scheduler
+        """
+        handler = getattr(self, 'on_' + event['event'], None)
+        if handler is not None:
+            handler(event)
+
+    def get_task_state(self, event):
+        """
+        Return times of open spans of task.
+        @param event dict
+        @return dict
+        """
+        return self.task_states.setdefault(event['row_id'], {})
+
+    def add_span(self, name, pid, tid, start, end, args=None):
+        """
+        @param name str
+        @param pid int, ID of process in trace
+        @param tid int, ID of track in trace
+        @param start float, Time in seconds since epoch
+        @param end float, Time in seconds since epoch
+        @param args dict, Additional data shown by viewer
+        """
+        self.events.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                            'ts': int(start * 1e6),
+                            'dur': int(max(0.0, end - start) * 1e6),
+                            'args': args or {}})
+
+    def add_instant(self, name, pid, tid, time, args=None):
+        """
+        @param name str
+        @param pid int, ID of process in trace
+        @param tid int, ID of track in trace
+        @param time float, Time in seconds since epoch
+        @param args dict, Additional data shown by viewer
+        """
+        self.events.append({'name': name, 'ph': 'i', 's': 't', 'pid': pid,
+                            'tid': tid, 'ts': int(time * 1e6),
+                            'args': args or {}})
+
+    def close_running_span(self, event, state, end):
+        """
+        Close span of task running in slot.
+        @param event dict
+        @param state dict, State of task
+        @param end float
+        """
+        if 'running' not in state:
+            return
+
+        start, slot, cpus = state.pop('running')
+        self.add_span(os.path.basename(event['input_file']), self.slots_pid,
+                      slot, start, end,
+                      {'file': event['input_file'], 'queue': event['queue'],
+                       'priority': event['priority'], 'cpus': cpus})
+
+    def on_scheduler_started(self, event):
+        self.reset()
+        self.run_start = event['time']
+
+    def on_scheduler_paused(self, event):
+        self.pause_start = event['time']
+
+    def on_scheduler_resumed(self, event):
+        if self.pause_start is not None:
+            self.add_span('paused', self.slots_pid, -1, self.pause_start,
+                          event['time'])
+            self.pause_start = None
+
+    def on_task_probing(self, event):
+        self.get_task_state(event).setdefault('probe', event['time'])
+
+    def on_task_probed(self, event):
+        state = self.get_task_state(event)
+        if 'probe' in state:
+            self.add_span('probe', self.queue_pid, event['row_id'],
+                          state.pop('probe'), event['time'])
+
+    def on_task_held(self, event):
+        self.get_task_state(event)['held'] = (event['time'],
+                                              event['admission'])
+
+    def on_task_admitted(self, event):
+        state = self.get_task_state(event)
+        if 'held' in state:
+            start, admission = state.pop('held')
+            self.add_span('held', self.queue_pid, event['row_id'], start,
+                          event['time'], {'admission': admission})
+
+    def on_task_started(self, event):
+        state = self.get_task_state(event)
+        now = event['time']
+
+        queued_at = state.pop('queued_at', event['queued_at'])
+        if queued_at:
+            self.add_span('queued', self.queue_pid, event['row_id'],
+                          max(queued_at, self.run_start or queued_at), now,
+                          {'file': event['input_file'],
+                           'queue': event['queue']})
+
+        state['running'] = (now, event['slot'], event['cpus'])
+        self.add_instant('spawned', self.slots_pid, event['slot'], now,
+                         {'pid': event['pid']})
+
+    def on_task_preempted(self, event):
+        state = self.get_task_state(event)
+        self.close_running_span(event, state, event['time'])
+        state['preempted'] = event['time']
+
+    def on_task_resumed(self, event):
+        state = self.get_task_state(event)
+        if 'preempted' in state:
+            self.add_span('preempted', self.queue_pid, event['row_id'],
+                          state.pop('preempted'), event['time'])
+        state['running'] = (event['time'], event['slot'], None)
+
+    def on_task_stalled(self, event):
+        state = self.get_task_state(event)
+        if 'running' in state:
+            self.add_instant('stalled', self.slots_pid, state['running'][1],
+                             event['time'], {'reason': event['reason']})
+        self.close_running_span(event, state, event['time'])
+
+    def on_task_retried(self, event):
+        self.task_states[event['row_id']] = {'queued_at': event['time']}
+
+    def on_task_exited(self, event):
+        state = self.get_task_state(event)
+        if 'running' not in state:
+            return
+
+        slot = state['running'][1]
+        if event['first_output']:
+            self.add_instant('first output', self.slots_pid, slot,
+                             event['first_output'])
+
+        end_time = event['end_time'] or event['time']
+        self.close_running_span(event, state, end_time)
+        self.add_instant('exited', self.slots_pid, slot, end_time,
+                         {'returncode': event['returncode'],
+                          'frames': event['frames']})
+        state['verify'] = (event['time'], slot)
+
+    def on_task_verified(self, event):
+        state = self.get_task_state(event)
+        if 'verify' in state:
+            start, slot = state.pop('verify')
+            self.add_span('verify', self.slots_pid, slot, start,
+                          event['time'], {'complete': event['complete']})
+
+    def on_task_publishing(self, event):
+        self.get_task_state(event)['publish'] = event['time']
+
+    def on_task_finished(self, event):
+        state = self.task_states.pop(event['row_id'], {})
+        if 'publish' in state:
+            self.add_span('publish', self.queue_pid, event['row_id'],
+                          state['publish'], event['time'],
+                          {'status': event['status']})
+        self.add_instant(event['status'], self.queue_pid, event['row_id'],
+                         event['time'])
+
+    def on_task_cancelled(self, event):
+        state = self.task_states.pop(event['row_id'], {})
+        self.close_running_span(event, state, event['time'])
+        self.add_instant('cancelled', self.queue_pid, event['row_id'],
+                         event['time'])
+
+    def on_scheduler_stopped(self, event):
+        if self.run_start is None:
+            return
+
+        self.on_scheduler_resumed(event)
+
+        events, self.events = self.events, []
+        self.task_states.clear()
+        self.run_start = None
+
+        d = self.write(events)
+        d.addCallback(lambda file_path: self.logger.info(
+            'Timeline written to %s', file_path))
+        d.addErrback(lambda fail: self.logger.error(
+            'Writing of timeline failed: %s', fail.getErrorMessage()))
+
+    def get_metadata(self, events):
+        """
+        Return events naming processes and tracks of trace.
+        @param events list
+        @return list
+        """
+        metadata = [{'name': 'process_name', 'ph': 'M', 'pid': self.slots_pid,
+                     'args': {'name': 'slots'}},
+                    {'name': 'process_name', 'ph': 'M', 'pid': self.queue_pid,
+                     'args': {'name': 'queue'}}]
+
+        tracks = set((e['pid'], e['tid']) for e in events)
+        for pid, tid in sorted(tracks):
+            if pid == self.slots_pid:
+                name = 'scheduler' if tid < 0 else 'slot %d' % tid
+            else:
+                name = 'task %d' % tid
+            metadata.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                             'tid': tid, 'args': {'name': name}})
+
+        return metadata
+
+    @async_function
+    def write(self, events):
+        """
+        Write trace of run to new file.
+        @param events list, Recorded events
+        @return t.i.d.Deferred, str, Path to file
+        """
+        trace_dir_path = os.path.join(get_app_dir(), 'trace')
+        if not os.path.exists(trace_dir_path):
+            os.mkdir(trace_dir_path)
+
+        file_name = 'Trace_%s.json' % datetime.now()
+        # colon is not allowed in windows path
+        file_name = file_name.replace(':', '-')
+        file_path = os.path.join(trace_dir_path, file_name)
+
+        trace = {'traceEvents': self.get_metadata(events) + events,
+                 'displayTimeUnit': 'ms'}
+        with open(file_path, 'w') as f:
+            json.dump(trace, f)
+
+        return file_path
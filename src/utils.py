@@ -99,12 +99,16 @@ def get_app_dir():
 def setup_logging():
     """
     Set up logging module according to options in application's configuration
-    file.
+    file. Records are enqueued and written by background thread, log file is
+    rotated by size.
     """
+    import atexit
     import logging
     import os.path
+    import Queue as queue
     from twisted.python import log
     from config import Configuration
+    from logwriter import LogWriter, QueueHandler
 
     config = Configuration()
 
@@ -138,7 +142,22 @@ def setup_logging():
     print ("Openning log '%s' with level %s"
            % (filepath if filepath else filename, logging.getLevelName(level)))
 
-    logging.basicConfig(level=level, filename=filepath)
+    max_size = config.getint('logging', 'max_size') * 1024 * 1024
+    backup_count = config.getint('logging', 'backup_count')
+    compress = config.getboolean('logging', 'compress')
+
+    records = queue.Queue()
+
+    writer = LogWriter(records, filepath, max_size, backup_count, compress)
+    writer.start()
+    atexit.register(writer.stop)
+
+    handler = QueueHandler(records)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    root_logger = logging.getLogger()
+    root_logger.addHandler(handler)
+    root_logger.setLevel(level)
 
 
 def async_function(fnc):
@@ -185,10 +204,59 @@ class WatchingProcessProtocol(protocol.ProcessProtocol):
         """
         self.deferred = deferred
 
-    def processExited(self, status):
+    def processEnded(self, status):
         """
-        Raise errback of protocol's deferred after process termination. Pass
+        Raise errback of protocol's deferred after process termination and
+        closing of its pipes, so no output is received later. Pass
         t.i.e.ProcessDone or t.i.e.ProcessTerminated as parameter. It contains
         return value or signal number (that killed the process)
         """
         self.deferred.errback(status)
+
+
+class CollectingProcessProtocol(WatchingProcessProtocol):
+    """
+    WatchingProcessProtocol that collects stdout and stderr of process in
+    memory. Useful for short-running helper processes with small output.
+    """
+    def __init__(self, deferred):
+        """
+        Save deferred and prepare buffers.
+        @param deferred t.i.d.Deferred
+        """
+        WatchingProcessProtocol.__init__(self, deferred)
+        self.stdout_chunks = []
+        self.stderr_chunks = []
+
+    def outReceived(self, data):
+        self.stdout_chunks.append(data)
+
+    def errReceived(self, data):
+        self.stderr_chunks.append(data)
+
+    @property
+    def stdout(self):
+        return ''.join(self.stdout_chunks)
+
+    @property
+    def stderr(self):
+        return ''.join(self.stderr_chunks)
+
+
+def spawn_process(process_protocol, args, **kwargs):
+    """
+    Spawn process by reactor. On win32 platform process is started without
+    console window.
+    @param process_protocol t.i.p.ProcessProtocol
+    @param args list, Command arguments, first one is executable
+    @param kwargs dict, Additional arguments of reactor.spawnProcess
+    @return t.i.i.IProcessTransport
+    """
+    import sys
+    from twisted.internet import reactor
+
+    if sys.platform == 'win32':
+        import win32process
+        kwargs['win32flags'] = win32process.CREATE_NO_WINDOW
+
+    return reactor.spawnProcess(process_protocol, args[0], args, **kwargs)
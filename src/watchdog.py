@@ -0,0 +1,124 @@
+# -*- coding: utf8 -*-
+"""
+Provides class used to detect hanging conversion processes.
+"""
+
+import logging
+
+from twisted.internet import task as tx_task
+
+from config import Configuration
+
+
+class StallWatchdog(object):
+    """
+    Class that periodically checks processes of running tasks. Process is
+    stalled when it has made no progress (or has produced no output when
+    progress is not known) for stall timeout or when it's running longer than
+    timeout scaled to probed duration of input. Suspended processes are not
+    checked and time of suspension is not counted.
+
+    Stalled task is passed to callback and is not watched anymore.
+    """
+    def __init__(self, stalled_callback):
+        """
+        Read settings from configuration and set object's attributes.
+        @param stalled_callback callable, Called with task and reason
+        """
+        self.stalled_callback = stalled_callback
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.config = Configuration()
+
+        self.stall_timeout = self.config.getint('watchdog', 'stall_timeout')
+        self.duration_factor = self.config.getfloat('watchdog',
+                                                    'duration_factor')
+        self.min_timeout = self.config.getint('watchdog', 'min_timeout')
+        self.kill_delay = self.config.getfloat('watchdog', 'kill_delay')
+        self.retries = self.config.getint('watchdog', 'retries')
+        self.check_interval = self.config.getfloat('watchdog',
+                                                   'check_interval')
+
+        self.tasks = set()
+
+        self.looping_call = tx_task.LoopingCall(self.check)
+
+    def start(self):
+        """
+        Start watching of tasks.
+        """
+        if not self.looping_call.running:
+            self.looping_call.start(self.check_interval, now=False)
+
+    def stop(self):
+        """
+        Stop watching of tasks.
+        """
+        if self.looping_call.running:
+            self.looping_call.stop()
+
+        self.tasks.clear()
+
+    def watch(self, task):
+        """
+        Start watching of task's process.
+        @param task Task
+        """
+        self.tasks.add(task)
+
+    def unwatch(self, task):
+        """
+        Stop watching of task's process.
+        @param task Task
+        """
+        self.tasks.discard(task)
+
+    def check(self):
+        """
+        Check all watched tasks and pass stalled ones to callback.
+        """
+        for task in list(self.tasks):
+            reason = self.get_stall_reason(task)
+            if reason is None:
+                continue
+
+            self.logger.warning('Task %s stalled: %s', task, reason)
+            self.tasks.discard(task)
+            self.stalled_callback(task, reason)
+
+    def get_stall_reason(self, task):
+        """
+        @param task Task
+        @return str or None, Reason why task is stalled or None if it isn't
+        """
+        process = task.process
+        if not process.started or process.finished or process.holds:
+            return None
+
+        idle_time = process.get_idle_time()
+        if self.stall_timeout > 0 and idle_time > self.stall_timeout:
+            return 'no progress for %d s' % idle_time
+
+        timeout = self.get_timeout(task)
+        run_time = process.get_run_time()
+        if timeout is not None and run_time > timeout:
+            return 'running for %d s, timeout is %d s' % (run_time, timeout)
+
+        return None
+
+    def get_timeout(self, task):
+        """
+        Return timeout of task scaled to duration of its input.
+        @param task Task
+        @return float or None, Timeout in seconds or None when duration is not
+            known or timeout is disabled
+        """
+        if self.duration_factor <= 0:
+            return None
+
+        info = task.media_info
+        if info is None or info.duration is None:
+            return None
+
+        return max(self.min_timeout, info.duration * self.duration_factor)